@@ -0,0 +1,155 @@
+from utils import *
+
+import numpy as np
+
+
+def draw_blocks(n, time_limit, num_doors, rng = None, antithetic = False):
+    """ Draws one (time_limit, 1 + num_doors) block of uniforms per episode:
+    the stall draw and then every door's flip draw for each timestep. Blocks
+    are contiguous in the stream, so episode i gets the same draws however
+    episodes are split into chunks. With antithetic, episodes 2k and 2k+1
+    use mirrored draws u and 1 - u """
+    if rng is None:
+        rng = np.random
+    if not antithetic:
+        return rng.random((n, time_limit, 1 + num_doors))
+    if n % 2 != 0:
+        raise ValueError('antithetic sampling needs an even number of simulations')
+    blocks = rng.random((n // 2, 1, time_limit, 1 + num_doors))
+    return np.concatenate([blocks, 1 - blocks], axis=1).reshape(n, time_limit,
+                                                                1 + num_doors)
+
+
+def draw_uniforms(n, time_limit, num_doors, rng = None, antithetic = False):
+    """ Draws blocks for n episodes (see draw_blocks) and lays them out by
+    timestep as (time_limit, n) stall and (time_limit, n, num_doors) door draws """
+    blocks = draw_blocks(n, time_limit, num_doors, rng, antithetic)
+    return (np.ascontiguousarray(blocks[:, :, 0].T),
+            np.ascontiguousarray(blocks[:, :, 1:].transpose(1, 0, 2)))
+
+
+class BatchSimulator:
+    """ Steps many episodes of Environment.run at once as numpy arrays """
+
+    def __init__(self, env, door_changes = {}, original_runtime = 0,
+                 chunk_size = 65536, prob_stall = None, prob_door = None,
+                 time_limit = None):
+        # prob_stall, prob_door and time_limit override the values env was
+        # built with, so one compiled world can be evaluated at many settings
+        self.grid = env.world.compile()
+        self.time_limit = self.grid.time_limit if time_limit is None else time_limit
+        self.original_runtime = original_runtime
+        self.prob_stall = env.agent.prob_stall if prob_stall is None else prob_stall
+        self.chunk_size = chunk_size
+
+        # The agent never leaves its planned path (it only stalls or waits at
+        # closed doors), so an episode is fully described by a cursor into it
+        self.path = None
+        if self.grid.goal >= 0:
+            self.path = self.grid.shortest_path(self.grid.start_cells[env.agent.path],
+                                                self.grid.goal)
+
+        # Only doors directly right of a path cell can ever block the agent
+        self.doors = []
+        self.door_bit = []
+        for cell in (self.path or []):
+            d = self.grid.door_right_of[cell]
+            if d < 0:
+                self.door_bit.append(-1)
+                continue
+            if d not in self.doors:
+                self.doors.append(d)
+            self.door_bit.append(self.doors.index(d))
+        if len(self.doors) > 64:
+            raise ValueError('batch engine supports at most 64 doors on a path')
+        self.door_bit = np.array(self.door_bit, dtype=np.int64)
+
+        # A path can cut through a blocked square, which the agent can never
+        # step into, so it is stuck for good in front of it
+        self.stuck = np.zeros(len(self.path or []), dtype=bool)
+        if self.path is not None:
+            self.stuck[:-1] = self.grid.blocked[self.path[1:]]
+        self.door_probs = self.grid.door_probs[self.doors]
+        if prob_door is not None:
+            self.door_probs = np.full(len(self.doors), prob_door)
+        self.bit_values = np.left_shift(np.uint64(1),
+                                        np.arange(len(self.doors), dtype=np.uint64))
+        self.initial_mask = np.bitwise_or.reduce(
+            self.bit_values[self.grid.door_open[self.doors]], initial=np.uint64(0))
+
+        # Scheduled flips replayed deterministically up to original_runtime,
+        # as masks over the world's doors narrowed to the doors on the path
+        self.schedule = np.zeros(self.time_limit + 1, dtype=np.uint64)
+        world_schedule = env.world.compile_door_changes(door_changes, self.time_limit)
+        for t, changed in enumerate(world_schedule):
+            for bit, d in enumerate(self.doors):
+                if (changed >> int(d)) & 1:
+                    self.schedule[t] |= self.bit_values[bit]
+
+
+    def run(self, num_simulations, rng = None, return_counts = False):
+        """ Returns won flags and finishing timesteps for every episode, and
+        optionally its event counts (see run_chunk) """
+        won = np.zeros(num_simulations, dtype=bool)
+        timesteps = np.zeros(num_simulations, dtype=np.int64)
+        counts = np.zeros((num_simulations, 4), dtype=np.int64)
+        for start in range(0, num_simulations, self.chunk_size):
+            end = min(start + self.chunk_size, num_simulations)
+            won[start:end], timesteps[start:end], counts[start:end] =\
+                self.run_chunk(end - start, rng)
+        if return_counts:
+            return won, timesteps, counts
+        return won, timesteps
+
+
+    def run_chunk(self, n, rng = None, uniforms = None):
+        """ Simulates n episodes in lockstep from pre-drawn random blocks.
+        uniforms can be shared between models, with door draws for every
+        door in the world, to evaluate them on common random numbers.
+
+        Also returns each episode's sufficient statistics for reweighting to
+        other parameters: counts of stalls, stall draws, door flips and
+        random door draws (for doors on the path) until the episode ended """
+        T = self.time_limit
+        won = np.zeros(n, dtype=bool)
+        timesteps = np.full(n, T, dtype=np.int64)
+        counts = np.zeros((n, 4), dtype=np.int64)
+        if self.path is None:
+            return won, timesteps, counts
+
+        # Draws cover all doors of the world, as in Environment.run, so the
+        # same stream gives the same episodes in both engines
+        if uniforms is None:
+            uniforms = draw_uniforms(n, T, self.grid.num_doors, rng)
+        stall_u, door_u = uniforms[0], uniforms[1][:, :, self.doors]
+
+        goal = len(self.path) - 1
+        cursor = np.zeros(n, dtype=np.int64)
+        mask = np.full(n, self.initial_mask, dtype=np.uint64)
+        has_door = self.door_bit >= 0
+        safe_bit = np.maximum(self.door_bit, 0).astype(np.uint64)
+
+        for t in range(1, T + 1):
+            alive = ~won
+            stalled = stall_u[t - 1] < self.prob_stall
+            counts[:, 0] += alive & stalled
+            counts[:, 1] += alive
+            moving = alive & ~stalled
+            here = np.minimum(cursor, goal)
+            is_open = (mask >> safe_bit[here]) & np.uint64(1)
+            blocked = self.stuck[here] | (has_door[here] & (is_open == 0))
+            cursor += moving & ~blocked
+
+            if t <= self.original_runtime:
+                mask ^= self.schedule[t]
+            elif len(self.doors) > 0:
+                flips = door_u[t - 1] < self.door_probs
+                mask ^= (flips * self.bit_values).sum(axis=1, dtype=np.uint64)
+                counts[:, 2] += alive * flips.sum(axis=1)
+                counts[:, 3] += alive * len(self.doors)
+
+            reached = alive & (cursor == goal)
+            timesteps[reached] = t
+            won |= reached
+
+        return won, timesteps, counts
@@ -0,0 +1,80 @@
+import os
+import json
+import time
+import pickle
+import sqlite3
+import hashlib
+import numpy as np
+
+
+def file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def rng_state_hash():
+    """ Digest of the global numpy RNG state, which stands in for the seed
+    since models draw from wherever the previous model left the stream """
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    data = repr((name, pos, has_gauss, cached_gaussian)).encode() + keys.tobytes()
+    return hashlib.sha256(data).hexdigest()
+
+
+class ResultCache:
+    """ Content-addressed store of model results in SQLite, evicting the
+    least recently used entries once it grows past max_bytes """
+
+    def __init__(self, path, max_bytes = 64 * 2**20):
+        self.max_bytes = max_bytes
+        if os.path.dirname(path) != '':
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, '
+                        'value TEXT, rng_state BLOB, size INTEGER, last_used REAL)')
+        # the cache may have been filled with a larger limit
+        self.evict()
+        self.db.commit()
+
+
+    def key(self, **parts):
+        # Grid hashes and trial contents are part of the key, so editing a grid
+        # or experiment.json leaves old entries unreachable until evicted
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+    def get(self, key):
+        """ Returns (value, rng state after computing it), or None on a miss """
+        row = self.db.execute('SELECT value, rng_state FROM results WHERE key = ?',
+                              (key,)).fetchone()
+        if row is None:
+            return None
+        self.db.execute('UPDATE results SET last_used = ? WHERE key = ?',
+                        (time.time(), key))
+        self.db.commit()
+        return json.loads(row[0]), pickle.loads(row[1])
+
+
+    def put(self, key, value, rng_state):
+        value = json.dumps(value)
+        rng_state = pickle.dumps(rng_state)
+        self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+                        (key, value, rng_state, len(value) + len(rng_state), time.time()))
+        self.evict()
+        self.db.commit()
+
+
+    def evict(self):
+        """ Deletes least recently used entries until the rest fit in max_bytes """
+        total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+        rows = self.db.execute('SELECT key, size FROM results ORDER BY last_used')
+        to_delete = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            to_delete.append((key,))
+            total -= size
+        self.db.executemany('DELETE FROM results WHERE key = ?', to_delete)
+
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,96 @@
+from gridworld import *
+
+import sys
+import argparse
+import numpy as np
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser("shortest path check argument parser")
+
+    parser.add_argument('--n-random', type=int, default=200, help='number of random grids to check besides the ones in grids/')
+    parser.add_argument('--max-size', type=int, default=8, help='maximum width and height of the random grids')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the random grids')
+
+    return parser.parse_args()
+
+
+def random_grid(rng, max_size):
+    """ Returns a grid in the grids/*.txt format with random blocked squares
+    and doors, a goal and both start squares """
+    width, height = rng.integers(2, max_size + 1, size=2)
+    cells = rng.choice([' ', 'X'], size=(height, width), p=[0.7, 0.3])
+    special = rng.choice(width * height, 3, replace=False)
+    for rep, cell in zip(['g', 'r', 'b'], special):
+        cells[cell // width, cell % width] = rep
+    door_lines = []
+    rows = []
+    for y in range(height):
+        row = cells[y, 0]
+        for x in range(1, width):
+            if rng.random() < 0.1:
+                row += '|'
+                door_lines.append(str(rng.integers(0, 2)))
+            else:
+                row += '.'
+            row += cells[y, x]
+        rows.append(row)
+    return '\n'.join(door_lines + [''] + rows) + '\n'
+
+
+def reachability_graph(world):
+    """ Builds the networkx graph the planner originally searched """
+    import networkx as nx
+    graph = nx.Graph()
+    for location in world.get_all_locations():
+        graph.add_node(location)
+        for action in [DOWN, UP, LEFT, RIGHT]:
+            if world.is_valid_action(location, action):
+                new_location = world.get_new_location(location, action)
+                if new_location in graph:
+                    graph.add_edge(location, new_location)
+    return graph
+
+
+def check_world(world):
+    """ Returns the (source, target) pairs whose path or distance differs
+    from networkx's """
+    import networkx as nx
+    graph = reachability_graph(world)
+    mismatches = []
+    for source in world.get_all_locations():
+        for target in world.get_all_locations():
+            try:
+                expected = nx.shortest_path(graph, source, target)
+            except nx.NetworkXNoPath:
+                expected = None
+            distance = None if expected is None else len(expected) - 1
+            if world.get_shortest_path(source, target) != expected or \
+                    world.get_gridsquares_between(source, target) != distance:
+                mismatches.append((source, target))
+    return mismatches
+
+
+if __name__ == '__main__':
+    arglist = parse_arguments()
+    worlds = []
+    for trial in read_trials():
+        gw = GridWorld(prob_door = 0.19)
+        gw.read_world(filename = trial['num'])
+        worlds.append(gw)
+    rng = np.random.default_rng(arglist.seed)
+    for i in range(arglist.n_random):
+        gw = GridWorld(prob_door = 0.19)
+        gw.parse_world(random_grid(rng, arglist.max_size))
+        worlds.append(gw)
+
+    num_pairs = 0
+    failed = 0
+    for gw in worlds:
+        mismatches = check_world(gw)
+        num_pairs += (gw.width * gw.height) ** 2
+        failed += len(mismatches)
+        for source, target in mismatches[:3]:
+            print('{} differs from networkx from {} to {}'.format(gw.name, source, target))
+    print('{} of {} paths in {} grids differ from networkx'.format(failed, num_pairs, len(worlds)))
+    sys.exit(1 if failed > 0 else 0)
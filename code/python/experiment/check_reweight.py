@@ -0,0 +1,74 @@
+from main import make_env, make_model
+from utils import read_trials, spawn_rng
+
+import io
+import sys
+import argparse
+import itertools
+import contextlib
+import numpy as np
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser("reweighting check argument parser")
+
+    parser.add_argument('--n-simulations', type=int, default=20000, help='number of simulations to reweight for each trial and model')
+    parser.add_argument('--base-prob-stall', type=float, default=0.12, help='stall probability simulated at')
+    parser.add_argument('--base-prob-door', type=float, default=0.19, help='door switching probability simulated at')
+    parser.add_argument('--min-ess', type=float, default=50, help='effective sample size below which estimates are too noisy to compare')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the simulations')
+
+    return parser.parse_args()
+
+
+def check_model(model, arglist, rng):
+    """ Compares reweighted success rates with exact ones at the base
+    probabilities and at 0 and 1, returning how many points were compared
+    and which of them failed """
+    probs = [0., 1.]
+    points = list(itertools.product(probs + [arglist.base_prob_stall],
+                                    probs + [arglist.base_prob_door]))
+    results = model.reweighted_success_rates(arglist.n_simulations, points, rng,
+        prob_stall = arglist.base_prob_stall, prob_door = arglist.base_prob_door)
+    compared = 0
+    failed = []
+    for r in results:
+        exact = model.success_probability(prob_stall = r['prob_stall'],
+                                          prob_door = r['prob_door'])
+        if not (np.isfinite(r['success_rate']) and np.isfinite(r['ess'])):
+            failed.append((r, exact))
+        elif r['ess'] == 0:
+            # no simulated episode is possible at this point
+            if r['success_rate'] != 0:
+                failed.append((r, exact))
+        elif r['ess'] >= arglist.min_ess:
+            compared += 1
+            # the weights average to 1, so their mean square is n / ess
+            # and the estimate's standard error at most 1 / sqrt(ess)
+            if abs(r['success_rate'] - exact) > 4 / np.sqrt(r['ess']):
+                failed.append((r, exact))
+    return compared, failed
+
+
+if __name__ == '__main__':
+    arglist = parse_arguments()
+    params = argparse.Namespace(prob_stall = arglist.base_prob_stall,
+                                prob_door = arglist.base_prob_door, time_limit = 10)
+    compared = 0
+    failed = 0
+    for trial in read_trials():
+        env = make_env(trial, params)
+        original_runtime, _ = env.run(door_changes = trial['door_changes'])
+        for m, model_type in enumerate(['cf', 'hyp']):
+            model = make_model(env, model_type, trial, original_runtime)
+            with contextlib.redirect_stdout(io.StringIO()):
+                n, failures = check_model(model, arglist,
+                                          spawn_rng(arglist.seed, trial['num'], m))
+            compared += n
+            failed += len(failures)
+            for r, exact in failures:
+                print('trial {} {} at stall {} and door {}: reweighted {:.4f} (ess {:.1f}), exact {:.4f}'.format(
+                      trial['num'], model_type, r['prob_stall'], r['prob_door'],
+                      r['success_rate'], r['ess'], exact))
+    print('{} reweighted success rates failed, {} compared with exact ones'.format(failed, compared))
+    sys.exit(1 if failed > 0 else 0)
@@ -0,0 +1,63 @@
+import os
+import time
+import pickle
+import numpy as np
+
+
+class Checkpoint:
+    """ Saved progress of one unit of model runs: its success and simulation
+    counts so far (or, for models on common random numbers, the won flags of
+    every simulation so far) and the state of its random stream at that point,
+    so a resumed run makes exactly the draws the interrupted one would have """
+
+    def __init__(self, path, interval = 60, resume = False):
+        self.path = path
+        self.interval = interval
+        self.last_save = time.time()
+        self.state = {'successes': 0, 'count': 0, 'rng_state': None,
+                      'columns': None}
+        if resume and os.path.exists(path):
+            with open(path, 'rb') as f:
+                self.state = pickle.load(f)
+
+
+    def done(self):
+        return self.state['columns'] is not None
+
+
+    def restore(self, rng = None):
+        """ Moves rng (or the global stream) to the saved state and returns
+        the saved success and simulation counts """
+        if self.state['rng_state'] is not None:
+            if rng is None:
+                np.random.set_state(self.state['rng_state'])
+            else:
+                rng.bit_generator.state = self.state['rng_state']
+        return self.state['successes'], self.state['count']
+
+
+    def save(self, num_successes, num_simulations, rng = None):
+        """ Records progress, writing it out at most once per interval """
+        if time.time() - self.last_save < self.interval:
+            return
+        self.state['successes'] = num_successes
+        self.state['count'] = num_simulations
+        self.state['rng_state'] = np.random.get_state() if rng is None \
+            else rng.bit_generator.state
+        self.write()
+
+
+    def finish(self, columns):
+        """ Records the unit's results and where it left the global stream """
+        self.state['columns'] = columns
+        self.state['rng_state'] = np.random.get_state()
+        self.write()
+
+
+    def write(self):
+        # write then rename, so an interruption never leaves a partial file
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(self.state, f)
+        os.replace(tmp_path, self.path)
+        self.last_save = time.time()
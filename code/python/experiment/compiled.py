@@ -0,0 +1,196 @@
+from utils import *
+
+import numpy as np
+
+
+# Order in which the original networkx reachability graph stored each
+# location's neighbors, which decides how shortest paths break ties
+NEIGHBOR_ORDER = [UP, LEFT, DOWN, RIGHT]
+
+
+class CompiledGrid:
+    """ Compact array form of a GridWorld shared by simulators and planners """
+
+    def __init__(self, world):
+        self.width = world.width
+        self.height = world.height
+        self.time_limit = world.time_limit
+        self.num_cells = self.width * self.height
+
+        # Cells are numbered row by row, so per-cell arrays reshape to (height, width)
+        self.locations = [(x, y) for y in range(self.height) for x in range(self.width)]
+        self.blocked = np.zeros(self.num_cells, dtype=bool)
+        for cell, location in enumerate(self.locations):
+            gridsquare = world.get_gridsquare_at(location)
+            self.blocked[cell] = gridsquare is not None and gridsquare.name == 'Blocked'
+
+        self.start_cells = {}
+        for color in ['red', 'blue']:
+            self.start_cells[color] = self.cell(world.get_start_location(color))
+        goal = world.get_goal_location()
+        self.goal = -1 if goal is None else self.cell(goal)
+
+        doors = world.get_doors()
+        self.num_doors = len(doors)
+        self.door_locations = [d.location for d in doors]
+        self.door_probs = np.array([d.prob for d in doors], dtype=float)
+        self.door_open = np.array([d.is_open_original for d in doors], dtype=bool)
+        self.door_right_of = np.full(self.num_cells, -1, dtype=np.int64)
+        for cell, location in enumerate(self.locations):
+            d = world.get_door_right_of(location)
+            if d is not None:
+                self.door_right_of[cell] = doors.index(d)
+
+        self.link_neighbors()
+        self.distance_tables = {}
+        self.paths = {}
+
+
+    @classmethod
+    def from_arrays(cls, arrays, world):
+        """ Rebuilds a compiled grid saved with to_arrays, without recomputing
+        any tables or searching for the paths from the starts to the goal.
+        Door probabilities and the time limit come from world """
+        grid = cls.__new__(cls)
+        grid.width = int(arrays['width'])
+        grid.height = int(arrays['height'])
+        grid.time_limit = world.time_limit
+        grid.num_cells = grid.width * grid.height
+        grid.locations = [(x, y) for y in range(grid.height) for x in range(grid.width)]
+        grid.blocked = arrays['blocked']
+        grid.start_cells = dict(zip(['red', 'blue'], arrays['start_cells'].tolist()))
+        grid.goal = int(arrays['goal'])
+        grid.num_doors = len(arrays['door_open'])
+        grid.door_locations = [tuple(l) for l in arrays['door_locations'].tolist()]
+        grid.door_probs = np.array([d.prob for d in world.get_doors()], dtype=float)
+        grid.door_open = arrays['door_open']
+        grid.door_right_of = arrays['door_right_of']
+        grid.neighbors = [[other for other in row if other >= 0]
+                          for row in arrays['neighbors'].tolist()]
+        grid.distance_tables = {}
+        grid.paths = {}
+        if grid.goal >= 0:
+            grid.distance_tables[grid.goal] = arrays['goal_distances']
+            for start, path in zip(arrays['start_cells'].tolist(),
+                                   arrays['start_paths'].tolist()):
+                # padded with -1, and all -1 where the goal is unreachable
+                path = [cell for cell in path if cell >= 0]
+                grid.paths[start, grid.goal] = path or None
+        return grid
+
+
+    def to_arrays(self):
+        """ Returns the static tables as a dict of arrays for saving """
+        arrays = {'width': self.width, 'height': self.height,
+                  'blocked': self.blocked,
+                  'start_cells': np.array([self.start_cells['red'],
+                                           self.start_cells['blue']]),
+                  'goal': self.goal, 'door_open': self.door_open,
+                  'door_locations': np.array(self.door_locations,
+                                             dtype=np.int64).reshape(-1, 2),
+                  'door_right_of': self.door_right_of}
+        arrays['neighbors'] = np.full((self.num_cells, len(NEIGHBOR_ORDER)), -1,
+                                      dtype=np.int64)
+        for cell, neighbors in enumerate(self.neighbors):
+            arrays['neighbors'][cell, :len(neighbors)] = neighbors
+        if self.goal >= 0:
+            arrays['goal_distances'] = self.distances(self.goal)
+            paths = [self.shortest_path(self.start_cells[color], self.goal) or []
+                     for color in ['red', 'blue']]
+            arrays['start_paths'] = np.full((2, max(len(p) for p in paths)), -1,
+                                            dtype=np.int64)
+            for row, path in zip(arrays['start_paths'], paths):
+                row[:len(path)] = path
+        return arrays
+
+
+    def cell(self, location):
+        return location[1] * self.width + location[0]
+
+
+    def link_neighbors(self):
+        """ Lists each cell's neighbors in the graph paths are planned on,
+        which is the original reachability graph: it was built column by
+        column, linking every location to its earlier neighbors (above and to
+        the left) whenever moving there was valid. So two adjacent cells are
+        linked when the earlier of them is not blocked """
+        self.neighbors = [[] for cell in range(self.num_cells)]
+        for cell, (x, y) in enumerate(self.locations):
+            for dx, dy in NEIGHBOR_ORDER:
+                if not (0 <= x + dx < self.width and 0 <= y + dy < self.height):
+                    continue
+                other = self.cell((x + dx, y + dy))
+                earlier = other if (dx, dy) in [UP, LEFT] else cell
+                if not self.blocked[earlier]:
+                    self.neighbors[cell].append(other)
+
+
+    def distances(self, target):
+        """ Returns the number of steps from every cell to target cell, or -1
+        where it is unreachable """
+        if target not in self.distance_tables:
+            distances = np.full(self.num_cells, -1, dtype=np.int64)
+            distances[target] = 0
+            level = [target]
+            while level:
+                next_level = []
+                for v in level:
+                    for u in self.neighbors[v]:
+                        if distances[u] < 0:
+                            distances[u] = distances[v] + 1
+                            next_level.append(u)
+                level = next_level
+            self.distance_tables[target] = distances
+        return self.distance_tables[target]
+
+
+    def shortest_path(self, source, target):
+        """ Returns the list of cells from source to target, or None """
+        if (source, target) not in self.paths:
+            self.paths[source, target] = self.bidirectional_search(source, target)
+        return self.paths[source, target]
+
+
+    def bidirectional_search(self, source, target):
+        """ Searches from both ends at once, visiting neighbors in the same
+        order as networkx's shortest_path, so ties between equally short
+        paths are broken exactly as with the original networkx planner """
+        pred = {source: None}
+        succ = {target: None}
+        meet = source if source == target else None
+        forward_fringe = [source]
+        reverse_fringe = [target]
+        while meet is None and forward_fringe and reverse_fringe:
+            # expand the smaller fringe, the forward one on ties
+            forward = len(forward_fringe) <= len(reverse_fringe)
+            this_level = forward_fringe if forward else reverse_fringe
+            seen, other = (pred, succ) if forward else (succ, pred)
+            next_level = []
+            for v in this_level:
+                for w in self.neighbors[v]:
+                    if w not in seen:
+                        next_level.append(w)
+                        seen[w] = v
+                    if w in other:
+                        meet = w
+                        break
+                if meet is not None:
+                    break
+            if forward:
+                forward_fringe = next_level
+            else:
+                reverse_fringe = next_level
+        if meet is None:
+            return None
+
+        path = []
+        cell = meet
+        while cell is not None:
+            path.append(cell)
+            cell = pred[cell]
+        path.reverse()
+        cell = succ[path[-1]]
+        while cell is not None:
+            path.append(cell)
+            cell = succ[cell]
+        return path
@@ -1,13 +1,16 @@
-from game import *
-from utils import get_action_from_location
+from utils import *
 
-import os
-os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = 'hide'
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 from datetime import datetime
 
 
 
+# Everything that changes while an episode runs. The agent follows a fixed
+# policy table (after any actions given to run), so its location is all that
+# is left of its plan
+SimState = namedtuple('SimState', ['location', 'door_mask', 'timestep'])
+
+
 class Environment:
     def __init__(self, gridworld, agent, generating_trials = False,
                  trial_dir = 'trials'):
@@ -18,7 +21,20 @@ class Environment:
         if not self.generating_trials:
             self.trial_dir += '/{}_{}'.format(self.world.name,
                     datetime.now().strftime('%m-%d-%y_%H-%M-%S'))
-        self.agent.location = self.world.get_start_location(self.agent.path)
+        self.reset()
+
+
+    def snapshot(self):
+        """ Returns the current state, which restore() can return to """
+        return SimState(self.agent.location, self.door_mask, self.timestep)
+
+
+    def restore(self, state):
+        self.agent.location, self.door_mask, self.timestep = state
+
+
+    def is_door_open(self, door):
+        return (self.door_mask >> self.world.door_index[door]) & 1 == 1
     
 
     def reached_goal(self):
@@ -26,86 +42,111 @@ class Environment:
         return self.world.get_goal_location() == self.agent.location
 
 
-    def plan_path(self):
-        """ Returns a sequence of actions to the goal from the agent's current location """
-        goal_location = self.world.get_goal_location()
-        path = []
-        locations_in_path = self.world.get_shortest_path(self.agent.location, goal_location)
-        for i in range(1, len(locations_in_path)):
-            path.append(get_action_from_location(locations_in_path[i-1],
-                                                 locations_in_path[i]))
-        return path
-
-
-    def execute(self, path, verbose):
-        """ Executes a single action from given path, accounting for walls and doors """
+    def execute(self, verbose, stall_u = None):
+        """ Executes a single action from the given actions or else the
+        policy, accounting for walls and doors """
 
-        # Execute with uncertainty (random stalling)
-        if not self.generating_trials and bernoulli(self.agent.prob_stall):
-            if verbose: print('\tagent stalled')
-            return
+        # Execute with uncertainty (random stalling), drawing from the global
+        # stream unless the draw was made in advance
+        if not self.generating_trials:
+            if stall_u is None:
+                stalled = bernoulli(self.agent.prob_stall)
+            else:
+                stalled = stall_u < self.agent.prob_stall
+            if stalled:
+                if verbose: print('\tagent stalled')
+                return
     
-        action = tuple(path.pop(0))
         possible_door = self.world.get_door_right_of(self.agent.location)
-        if (not self.world.is_valid_action(self.agent.location, action)) or (possible_door is not None and not possible_door.is_open):
-            path.insert(0, action)
-        else:
-            new_location = self.world.get_new_location(self.agent.location, action)
+        if possible_door is not None and not self.is_door_open(possible_door):
+            return
+        if self.actions:
+            # A given action is retried until it can be taken, and once they
+            # run out the agent plans its way to the goal from where it is
+            action = self.actions[0]
+            if self.world.is_valid_action(self.agent.location, action):
+                self.agent.move_to(self.world.get_new_location(self.agent.location,
+                                                               action))
+                self.actions.pop(0)
+                if not self.actions:
+                    self.policy = self.world.get_policy(self.agent.location)
+            return
+        new_location = self.policy.get(self.agent.location)
+        if new_location is not None:
             self.agent.move_to(new_location)
        
 
-    def run(self, path = [], door_changes = defaultdict(lambda : []),
+    def run(self, path = None, door_changes = defaultdict(lambda : []),
             original_runtime = 0, verbose = False, visualize = False,
-            include_00 = True, no_sidebar = False):
-        """ Simulates agent interacting with environment after planning path """
+            include_00 = True, no_sidebar = False, schedule = None,
+            uniforms = None, save_frames = True, video_format = 'gif',
+            resume = False):
+        """ Simulates agent interacting with environment while following its
+        policy, from the start unless resume is set, in which case it
+        continues from the current state (see restore). A non-empty path of
+        actions is followed first, and the agent plans its way to the goal
+        from wherever they leave it. schedule is door_changes already compiled
+        by the world, and uniforms an episode's pre-drawn block from
+        batch.draw_blocks. When visualizing, frames are saved as pngs if
+        save_frames and streamed into a video of the trial unless
+        video_format is None """
+        if not resume:
+            self.reset()
+        if path:
+            self.actions = [tuple(action) for action in path]
+        if schedule is None:
+            schedule = self.world.compile_door_changes(door_changes)
         
         # Initialize game visualization
         if visualize:
-            self.game = Game(self.world, self.agent)
-            self.game.on_init(no_sidebar = no_sidebar)
+            from game import Game  # only rendering needs pygame
+            self.game = Game(self.world, self.agent, env = self)
+            self.game.on_init(no_sidebar = no_sidebar, headless = True)
             
             make_dir(self.trial_dir)
+            self.save_frames = save_frames
+            self.video = None
+            if video_format is not None:
+                self.video = VideoWriter('{}/full.{}'.format(self.trial_dir, video_format))
 
+            # The video holds its first frame a little longer
             if not no_sidebar:
                 # Visualize initial slide before decision 
                 self.game.on_render(time = self.world.time_limit, chose = False)
-                self.game.screenshot('{}/00.png'.format(self.trial_dir))
+                self.save_frame(0, repeat = 4 if include_00 else 0)
                 
             # Visualize first slide with decision
             self.game.on_render(time = self.world.time_limit)
-            self.game.screenshot('{}/01.png'.format(self.trial_dir))
+            self.save_frame(1, repeat = 1 if include_00 and not no_sidebar else 4)
 
-        # Initialize planner if path empty, otherwise follow path
         self.outcome = 'lost'
-        timestep = 0
+        timestep = self.timestep
 
-        for timestep in range(1, self.world.time_limit + 1):
+        for timestep in range(self.timestep + 1, self.world.time_limit + 1):
+            self.timestep = timestep
             if verbose: print('   timestep {}'.format(timestep))
-            
-            # Have planner generate initial path
-            if len(path) == 0:
-                path = self.plan_path()
 
-            self.execute(path, verbose)
+            draws = None if uniforms is None else uniforms[timestep - 1]
+            self.execute(verbose, None if draws is None else draws[0])
             if verbose: self.agent.print_status()
             
-            # Probabilistically change doors
-            for d in self.world.get_doors():
-                if self.generating_trials or timestep <= original_runtime:
-                    change_door = (str(timestep) in door_changes and\
-                                  list(d.location) in door_changes[str(timestep)])
-                elif bernoulli(d.prob):
-                    change_door = True
-                else:
-                    change_door = False
-                        
-                if change_door:
-                    d.is_open = not d.is_open
-                    if verbose: print('\tdoor at {} changed'.format(d.location))
+            # Replay the recorded door changes, then change doors probabilistically
+            if self.generating_trials or timestep <= original_runtime:
+                changed = schedule[timestep]
+            else:
+                changed = 0
+                for i, d in enumerate(self.world.get_doors()):
+                    if bernoulli(d.prob) if draws is None else draws[i + 1] < d.prob:
+                        changed |= 1 << i
+            self.door_mask ^= changed
+            if verbose and changed:
+                for i, d in enumerate(self.world.get_doors()):
+                    if (changed >> i) & 1:
+                        print('\tdoor at {} changed'.format(d.location))
 
             if visualize:
                 self.game.on_render(time = (self.world.time_limit - timestep))
-                self.game.screenshot('{}/{:02d}.png'.format(self.trial_dir, timestep + 1))
+                self.save_frame(timestep + 1)
             
             if self.reached_goal():
                 self.outcome = 'won'
@@ -118,21 +159,30 @@ class Environment:
         return timestep, self.outcome
 
 
+    def save_frame(self, number, repeat = 1):
+        """ Saves the current frame as a png and appends it to the video """
+        if self.save_frames:
+            self.game.screenshot('{}/{:02d}.png'.format(self.trial_dir, number))
+        if self.video is not None and repeat > 0:
+            self.video.append(self.game.frame(), repeat)
+
+
     def finish_game(self, timestep, no_sidebar, include_00):
-        """ Visualizes last slide and generates gif of the whole trial """
+        """ Visualizes last slide and finishes the video of the whole trial """
         if not no_sidebar:
             self.game.on_render(time = (self.world.time_limit - timestep),
                                 outcome = self.outcome)
-            self.game.screenshot('{}/{:02d}.png'.format(self.trial_dir, timestep + 2))
-        make_gif(self.trial_dir, self.trial_dir + '/full', include_00)
+            self.save_frame(timestep + 2)
+        if self.video is not None:
+            # hold the last frame a little longer too
+            self.video.append(self.game.frame(), 3)
+            self.video.close()
         self.game.on_cleanup()
         
     
     def reset(self):
-        """ Resets state of all doors in the gridworld and location of the agent """
-        
-        for d in self.world.get_doors():
-            d.is_open = d.is_open_original
-        self.agent.location = self.world.get_start_location(self.agent.path)
-        self.agent.reached_goal = False
-        
+        """ Returns the agent to its start and all doors to their original state """
+        start = self.world.get_start_location(self.agent.path)
+        self.policy = self.world.get_policy(start)
+        self.actions = []
+        self.restore(SimState(start, self.world.initial_door_mask, 0))
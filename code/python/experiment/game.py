@@ -11,6 +11,10 @@ from datetime import datetime
 
 save_dir = 'trials'
 
+# Arrow keys move the agent in the interactive window
+KeyToTuple = {pygame.K_DOWN: DOWN, pygame.K_UP: UP,
+              pygame.K_LEFT: LEFT, pygame.K_RIGHT: RIGHT}
+
 _image_library = {}
 def get_image(filename):
     global _image_library
@@ -24,10 +28,11 @@ def get_image(filename):
 
 
 class Game:
-    def __init__(self, gridworld, agent = None):
+    def __init__(self, gridworld, agent = None, env = None):
         self._running = True
         self.world = gridworld
         self.agent = agent
+        self.env = env  # holds door states while running; None draws them as read
         
         self.small_fsize = 18
         self.large_fsize = 42
@@ -52,83 +57,185 @@ class Game:
         self.height = self.scale * self.world.height + self.wall_width
 
 
-    def on_init(self, no_sidebar = False):
-        pygame.init()
+    def on_init(self, no_sidebar = False, headless = False):
+        """ Opens a window, or with headless draws to an offscreen surface
+        that needs no display """
         self.no_sidebar = no_sidebar
-        if self.no_sidebar:
-            self.screen = pygame.display.set_mode((self.width, self.height))
+        self.headless = headless
+        size = (self.width, self.height) if self.no_sidebar else \
+            (self.screen_width, self.height)
+        if self.headless:
+            pygame.font.init()
+            self.screen = pygame.Surface(size)
         else:
-            self.screen = pygame.display.set_mode((self.screen_width, self.height))
+            pygame.init()
+            self.screen = pygame.display.set_mode(size)
+        if not self.no_sidebar:
             self.small_font = pygame.font.SysFont('Arial', self.small_fsize)
             self.large_font = pygame.font.SysFont('Arial', self.large_fsize)
+        self.static = None
         self._running = True
 
 
     def on_event(self, event):
+        """ Handles an event, returning the areas of the screen it changed """
         if event.type == pygame.QUIT:
             self._running = False
+        elif event.type == pygame.WINDOWEXPOSED:
+            return [self.screen.get_rect()]
         elif event.type == pygame.KEYDOWN:
             # press enter to save
             if event.key == pygame.K_RETURN:
                 image_name = '{}_{}.png'.format(self.world.name,
                              datetime.now().strftime('%m-%d-%y_%H-%M-%S'))
                 self.screenshot('{}/{}'.format(save_dir, image_name))
-                return
-            if event.key in KeyToTuple.keys():
-                action = KeyToTuple[event.key]
-                self.agent.location = inbounds(np.add(self.agent.location, action),
-                        self.world.width, self.world.height)
-
-
-    def on_render(self, chose = True, time = 0, outcome = ''):
-        self.draw_gridsquares()
+            elif event.key in KeyToTuple.keys() and self.agent is not None:
+                location = self.world.get_new_location(self.agent.location,
+                                                       KeyToTuple[event.key])
+                if location != self.agent.location:
+                    dirty = [self.agent_rect(self.agent.location)]
+                    self.agent.move_to(location)
+                    return dirty + [self.agent_rect(location)]
+        elif event.type == pygame.MOUSEBUTTONDOWN:
+            # click a door to open or close it
+            for d, rect in self.door_rects.items():
+                if rect.collidepoint(event.pos):
+                    self.toggle_door(d)
+                    return [rect]
+        return []
+
+
+    def on_render(self, chose = True, time = 0, outcome = '', dirty = None):
+        """ Draws the frame, or with dirty only the given areas of it, and
+        shows what was drawn in the window """
+        if self.static is None:
+            self.render_static()
+        if dirty is not None:
+            self.screen.set_clip(dirty[0].unionall(dirty))
+        self.screen.blit(self.static, (0, 0))
+        self.draw_doors()
+        self.screen.blit(self.walls, (0, 0))
         self.draw_agent(chose)
         if not self.no_sidebar:
             self.draw_timer(time)
             self.draw_outcome(outcome)
-        pygame.display.flip()
-        pygame.display.update()
+        self.screen.set_clip(None)
+        if not self.headless:
+            if dirty is None:
+                pygame.display.flip()
+            else:
+                pygame.display.update(dirty)
+
+
+    def render_static(self):
+        """ Renders everything that doesn't change between frames once: the
+        grid with its sprites and labels, and the perimeter walls that are
+        drawn over the doors """
+        self.star = pygame.transform.scale(get_image('goal'),
+                                           (self.star_width, self.star_width))
+        self.eye = pygame.transform.scale(get_image('eye'), self.eye_size)
+        self.text_cache = {}
+
+        self.static = pygame.Surface(self.screen.get_size())
+        self.draw_gridsquares(self.static)
+        if not self.no_sidebar:
+            self.draw_labels(self.static)
 
+        self.walls = pygame.Surface(self.screen.get_size(), pygame.SRCALPHA)
+        self.walls.fill((0, 0, 0, 0))
+        self.draw_perimeter(self.walls)
 
-    def draw_gridsquares(self):
-        self.screen.fill(Color.WHITE)
+
+    def draw_gridsquares(self, surface):
+        """ Draws the grid without its doors. Fills that come after a door
+        in self.world.objects were drawn over it, so the parts of them
+        covering each door are kept to be redrawn after the door """
+        surface.fill(Color.WHITE)
 
         for location in self.world.get_all_locations():
             if location == (0, 1): continue
             tl = self.top_left(location)
             fill = pygame.Rect(tl[0], tl[1], self.scale, self.scale)
-            self.screen.fill(Color.FLOOR, fill)
-            pygame.draw.rect(self.screen, Color.LINE, fill, 1)
-            
+            surface.fill(Color.FLOOR, fill)
+            pygame.draw.rect(surface, Color.LINE, fill, 1)
+
+        self.door_overlaps = {}
+        self.door_rects = {}
+        scratch = pygame.Surface(surface.get_size())
         for o in self.world.objects:
             tl = self.top_left(o.location)
             fill = pygame.Rect(tl[0], tl[1], self.scale, self.scale)
             if o.name == 'Start':
-                self.screen.fill(o.color, fill)
+                surface.fill(o.color, fill)
             if o.name == 'Blocked':
-                self.screen.fill(Color.BLACK, fill)
+                surface.fill(Color.BLACK, fill)
             elif o.name == 'Goal':
-                star = pygame.transform.scale(get_image('goal'),
-                        (self.star_width, self.star_width))
-                self.screen.blit(star, np.add(tl, self.star_offset))
+                surface.blit(self.star, np.add(tl, self.star_offset))
             elif isinstance(o, Door):
-                if o.is_open:
-                    self.draw_door(start = tl, diff = (0, self.door_jut))
-                    self.draw_door(start = (tl[0], tl[1] + self.scale),
-                        diff = (0, -self.door_jut))
-                else:
-                    self.draw_door(start = tl, diff = (0, self.scale))
+                # everything either state of the door can touch
+                self.door_overlaps[o] = []
+                self.door_rects[o] = self.draw_door(scratch, o, True).union(
+                    self.draw_door(scratch, o, False))
+                continue
+            if o.name in ['Start', 'Blocked']:
+                for d, rect in self.door_rects.items():
+                    if rect.colliderect(fill):
+                        self.door_overlaps[d].append(rect.clip(fill))
+
+
+    def draw_labels(self, surface):
+        text_surface = self.small_font.render('time left:', True, Color.BLACK)
+        text_w, text_h = text_surface.get_size()
+        text_w_margin = (self.sidebar_right - text_w)//2
+        surface.blit(text_surface, (self.width + self.sidebar_left +\
+            text_w_margin, self.text_vspacing * 4))
+        self.timer_label_h = text_h
+
+        text_surface = self.small_font.render('result:', True, Color.BLACK)
+        text_w, text_h = text_surface.get_size()
+        text_w_margin = (self.sidebar_right - text_w)//2
+        surface.blit(text_surface, (self.width + self.sidebar_left +\
+            text_w_margin, self.height//2 + self.text_vspacing * 3))
+        self.outcome_label_h = text_h
+
 
-        self.draw_perimeter()
+    def draw_doors(self):
+        for d in self.world.get_doors():
+            self.draw_door(self.screen, d, self.is_door_open(d))
+            for rect in self.door_overlaps[d]:
+                self.screen.blit(self.static, rect.topleft, rect)
 
     
-    def draw_door(self, start, diff):
-        pygame.draw.line(self.screen, Color.DOOR, start_pos = start,
+    def is_door_open(self, door):
+        if self.env is None:
+            return door.is_open
+        return self.env.is_door_open(door)
+
+
+    def toggle_door(self, door):
+        if self.env is None:
+            door.is_open = not door.is_open
+        else:
+            self.env.door_mask ^= 1 << self.world.door_index[door]
+
+
+    def draw_door(self, surface, door, is_open):
+        """ Draws a door in either state, returning the area it covered """
+        tl = self.top_left(door.location)
+        if is_open:
+            return self.draw_door_line(surface, start = tl, diff = (0, self.door_jut)).union(
+                self.draw_door_line(surface, start = (tl[0], tl[1] + self.scale),
+                                    diff = (0, -self.door_jut)))
+        return self.draw_door_line(surface, start = tl, diff = (0, self.scale))
+
+
+    def draw_door_line(self, surface, start, diff):
+        return pygame.draw.line(surface, Color.DOOR, start_pos = start,
             end_pos = np.add(start, diff), width = self.door_width)
 
 
-    def draw_wall(self, start, diff):
-        pygame.draw.line(self.screen, Color.WALL, start_pos = start,
+    def draw_wall(self, surface, start, diff):
+        pygame.draw.line(surface, Color.WALL, start_pos = start,
             end_pos = np.add(start, diff), width = self.wall_width)
     
 
@@ -142,50 +249,51 @@ class Game:
                             (self.scale//2, self.scale//2))
         pygame.draw.circle(self.screen, Color.AGENT, center, self.agent_r)
         pygame.draw.circle(self.screen, Color.WHITE, center, self.agent_r, 2)
-        eye = pygame.transform.scale(get_image('eye'), self.eye_size)
-        self.screen.blit(eye, np.add(center, self.eye_offsets[0]))   # left eye
-        self.screen.blit(eye, np.add(center, self.eye_offsets[1]))   # right eye
+        self.screen.blit(self.eye, np.add(center, self.eye_offsets[0]))   # left eye
+        self.screen.blit(self.eye, np.add(center, self.eye_offsets[1]))   # right eye
+
+
+    def agent_rect(self, location):
+        """ Returns the area the agent covers when at location """
+        center = np.add(self.top_left(location), (self.scale//2, self.scale//2))
+        return pygame.Rect(center[0] - self.agent_r, center[1] - self.agent_r,
+                           self.agent_r * 2 + 1, self.agent_r * 2 + 1)
 
     
+    def render_text(self, text):
+        if text not in self.text_cache:
+            self.text_cache[text] = self.large_font.render(text, True, Color.BLACK)
+        return self.text_cache[text]
+
+
     def draw_timer(self, time):
-        text_surface = self.small_font.render('time left:', True, Color.BLACK)
-        text_w, text_h = text_surface.get_size()
-        text_w_margin = (self.sidebar_right - text_w)//2
-        self.screen.blit(text_surface, (self.width + self.sidebar_left +\
-            text_w_margin, self.text_vspacing * 4))
-        
-        surface = self.large_font.render(str(time), True, Color.BLACK)
+        surface = self.render_text(str(time))
         w, h = surface.get_size()
         w_margin = (self.sidebar_right - w)//2
         self.screen.blit(surface, (self.width + self.sidebar_left + w_margin,
-                                   self.text_vspacing * 5 + text_h))
+                                   self.text_vspacing * 5 + self.timer_label_h))
 
     
     def draw_outcome(self, outcome):
-        text_surface = self.small_font.render('result:', True, Color.BLACK)
-        text_w, text_h = text_surface.get_size()
-        text_w_margin = (self.sidebar_right - text_w)//2
-        self.screen.blit(text_surface, (self.width + self.sidebar_left +\
-            text_w_margin, self.height//2 + self.text_vspacing * 3))
         if outcome != '':
-            surface = self.large_font.render(outcome.upper(), True, Color.BLACK)
+            surface = self.render_text(outcome.upper())
             w, h = surface.get_size()
             w_margin = (self.sidebar_right - w)//2
             self.screen.blit(surface, (self.width + self.sidebar_left + w_margin,
-                                       self.height//2 + self.text_vspacing * 4 + text_h))
+                                       self.height//2 + self.text_vspacing * 4 + self.outcome_label_h))
         
 
-    def draw_perimeter(self):
-        self.draw_wall(self.top_left((0, 0)), (self.scale * self.world.width, 0))
-        self.draw_wall(self.top_left((self.world.width, 0)),
+    def draw_perimeter(self, surface):
+        self.draw_wall(surface, self.top_left((0, 0)), (self.scale * self.world.width, 0))
+        self.draw_wall(surface, self.top_left((self.world.width, 0)),
                        (0, self.scale * self.world.height))
-        self.draw_wall(self.top_left((0, self.world.height)),
+        self.draw_wall(surface, self.top_left((0, self.world.height)),
                        (self.scale * self.world.width, 0))
-        self.draw_wall(self.top_left((0, 1)),
+        self.draw_wall(surface, self.top_left((0, 1)),
                        (self.scale * (self.world.width - 1), 0))
-        self.draw_wall(self.top_left((self.world.width - 1, 1)),
+        self.draw_wall(surface, self.top_left((self.world.width - 1, 1)),
                        (0, self.scale))
-        self.draw_wall(self.top_left((0, 2)),
+        self.draw_wall(surface, self.top_left((0, 2)),
                        (self.scale * (self.world.width - 1), 0))
 
 
@@ -193,6 +301,12 @@ class Game:
         pygame.image.save(self.screen, image_path)
 
 
+    def frame(self):
+        """ Returns the screen as a (height, width, 3) view of its pixels,
+        which keeps the screen locked until it is released """
+        return pygame.surfarray.pixels3d(self.screen).transpose(1, 0, 2)
+
+
     def top_left(self, loc):
         tl = (self.scale * loc[0] + self.wall_width//2,
               self.scale * loc[1] + self.wall_width//2)
@@ -205,12 +319,19 @@ class Game:
 
 
     def on_execute(self, no_sidebar = False):
+        """ Runs the interactive window: arrow keys move the agent, clicking
+        a door opens or closes it and enter saves a screenshot. Sleeps until
+        an event arrives and redraws only the areas events changed """
         if self.on_init(no_sidebar) == False:
             self._running = False
 
+        self.on_render()
         while self._running:
+            # handle everything queued up before redrawing once
+            dirty = self.on_event(pygame.event.wait())
             for event in pygame.event.get():
-                self.on_event(event)
-            self.on_render()
+                dirty += self.on_event(event)
+            if self._running and len(dirty) > 0:
+                self.on_render(dirty = dirty)
         self.on_cleanup()
 
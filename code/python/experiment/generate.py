@@ -0,0 +1,187 @@
+from main import make_env, make_model, MODEL_KEYS
+from utils import spawn_rng
+
+import os
+import csv
+import json
+import argparse
+import itertools
+import multiprocessing
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser("trial generation argument parser")
+
+    parser.add_argument('--n-candidates', type=int, default=1000, help='number of candidate trials to generate and evaluate')
+    parser.add_argument('--width', type=int, default=7, help='number of columns in each generated grid')
+    parser.add_argument('--max-doors', type=int, default=2, help='maximum number of doors in each corridor')
+    parser.add_argument('--models', nargs='+', choices=['cf', 'hyp', 'actual'], default=['cf', 'hyp'], help='models to evaluate')
+    parser.add_argument('--engine', choices=['exact', 'batch'], default='exact', help='compute success rates exactly or by batch simulation')
+    parser.add_argument('--n-simulations', type=int, default=1000, help='number of simulations per model with --engine batch')
+    parser.add_argument('--prob-stall', type=float, default=0.12, help='probabilty of agent stalling on any time step')
+    parser.add_argument('--prob-door', type=float, default=0.19, help='probability of door switching on any time step')
+    parser.add_argument('--time-limit', type=int, default=10, help='time limit for agent')
+    parser.add_argument('--seed', type=int, default=0, help='seed that every candidate\'s layout, schedule and simulations are spawned from')
+    parser.add_argument('--jobs', type=int, default=0, help='number of processes to evaluate candidates across')
+    parser.add_argument('--batch-size', type=int, default=1000, help='number of candidates evaluated between writes')
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv', help='write a csv file, or a directory of parquet files')
+    parser.add_argument('--output', type=str, default='../../experiment/candidates.csv', help='where to append results')
+    parser.add_argument('--save-grids', type=str, default=None, help='directory to also write each candidate\'s grid to, as <num>.txt')
+
+    return parser.parse_args()
+
+
+def make_layout(rng, width, max_doors):
+    """ Returns a grid in the grids/*.txt format with the red and blue
+    corridors of the experiment, each with up to max_doors random doors """
+    door_lines = []
+    rows = []
+    for start in ['r', 'b']:
+        num_doors = rng.integers(0, min(max_doors, width - 1) + 1)
+        door_columns = set(rng.choice(range(1, width), num_doors, replace=False).tolist())
+        row = start
+        for x in range(1, width):
+            if x in door_columns:
+                row += '|'
+                door_lines.append(str(rng.integers(0, 2)))
+            else:
+                row += '.'
+            row += ' '
+        rows.append(row)
+    middle = ' ' + '.X' * (width - 2) + '.g'
+    return '\n'.join(door_lines + ['', rows[0], middle, rows[1]]) + '\n'
+
+
+def make_door_changes(rng, world):
+    """ Samples which doors change on each timestep, in the experiment.json format """
+    door_changes = {}
+    for t in range(1, world.time_limit + 1):
+        changed = [list(d.location) for d in world.get_doors() if rng.random() < d.prob]
+        if len(changed) > 0:
+            door_changes[str(t)] = changed
+    return door_changes
+
+
+def make_trial(num, arglist):
+    """ Generates candidate num, the same every time for a given seed """
+    rng = spawn_rng(arglist.seed, num)
+    trial = {'num': num, 'path': ['red', 'blue'][rng.integers(0, 2)],
+             'grid': make_layout(rng, arglist.width, arglist.max_doors)}
+    env = make_env(trial, arglist)
+    trial['door_changes'] = make_door_changes(rng, env.world)
+    return trial, env
+
+
+def evaluate_candidate(unit):
+    """ Runs the baseline and every model on one candidate, returning its row """
+    num, arglist = unit
+    trial, env = make_trial(num, arglist)
+    if arglist.save_grids is not None:
+        with open(os.path.join(arglist.save_grids, '{}.txt'.format(num)), 'w') as f:
+            f.write(trial['grid'])
+
+    original_runtime, outcome = env.run(door_changes = trial['door_changes'])
+    row = {'trial': num, 'path': trial['path'], 'outcome': outcome,
+           'original_runtime': original_runtime}
+    for model_type in arglist.models:
+        model = make_model(env, model_type, trial, original_runtime)
+        if arglist.engine == 'exact':
+            rate = model.success_probability()
+        else:
+            rng = spawn_rng(arglist.seed, num, MODEL_KEYS[model_type])
+            rate = model.simulate_batch(arglist.n_simulations, rng) / arglist.n_simulations
+        row[model_type + '_success_rate'] = round(rate * 100, 2)
+    # with the grid file, these make the candidate's experiment.json entry
+    row['door_changes'] = json.dumps(trial['door_changes'])
+    return row
+
+
+class CsvSink:
+    """ Appends rows to a csv file, syncing after every batch """
+
+    def __init__(self, path):
+        self.path = path
+
+
+    def last_completed(self):
+        """ Returns the last candidate written, dropping a row cut off by a crash """
+        if not os.path.exists(self.path):
+            return 0
+        with open(self.path, 'rb+') as f:
+            size = f.seek(0, os.SEEK_END)
+            f.seek(max(size - 65536, 0))
+            tail = f.read()
+            end = tail.rfind(b'\n') + 1
+            f.truncate(size - len(tail) + end)
+        lines = tail[:end].splitlines()
+        if len(lines) == 0 or not lines[-1][:1].isdigit():
+            return 0
+        return int(lines[-1].split(b',')[0])
+
+
+    def write(self, rows):
+        with open(self.path, 'a', newline='') as f:
+            w = csv.DictWriter(f, rows[0].keys())
+            if f.tell() == 0:
+                w.writeheader()
+            w.writerows(rows)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class ParquetSink:
+    """ Writes each batch of rows as its own parquet file in a directory,
+    named by its last candidate so resuming needs no reads """
+
+    def __init__(self, path):
+        import pyarrow
+        import pyarrow.parquet
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+
+    def last_completed(self):
+        parts = [name for name in os.listdir(self.path) if name.endswith('.parquet')]
+        return max([int(name.split('.')[0]) for name in parts], default=0)
+
+
+    def write(self, rows):
+        name = '{:09d}.parquet'.format(rows[-1]['trial'])
+        tmp_path = os.path.join(self.path, name + '.tmp')
+        self.pq.write_table(self.pa.Table.from_pylist(rows), tmp_path)
+        os.replace(tmp_path, os.path.join(self.path, name))
+
+
+def batched(iterable, n):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, n))
+        if len(batch) == 0:
+            return
+        yield batch
+
+
+if __name__ == '__main__':
+    arglist = parse_arguments()
+    sink = ParquetSink(arglist.output) if arglist.format == 'parquet' \
+        else CsvSink(arglist.output)
+    if arglist.save_grids is not None:
+        os.makedirs(arglist.save_grids, exist_ok=True)
+
+    # Candidates are generated lazily from their own streams and written in
+    # order, so everything up to the last row on disk is done
+    start = sink.last_completed() + 1
+    if start > 1:
+        print('resuming after candidate {}'.format(start - 1))
+    units = ((num, arglist) for num in range(start, arglist.n_candidates + 1))
+
+    pool = multiprocessing.Pool(arglist.jobs) if arglist.jobs > 0 else None
+    for batch in batched(units, arglist.batch_size):
+        rows = pool.map(evaluate_candidate, batch) if pool is not None \
+            else [evaluate_candidate(unit) for unit in batch]
+        sink.write(rows)
+        print('{} candidates done'.format(rows[-1]['trial']))
+    if pool is not None:
+        pool.close()
@@ -1,5 +1,10 @@
 from utils import *
-import networkx as nx
+from compiled import CompiledGrid
+import hashlib
+
+
+# bump whenever the compiled tables change, so old world caches are ignored
+COMPILED_VERSION = b'compiled-v4'
 
 
 class Rep:
@@ -40,6 +45,8 @@ class Door(GridElement):
     def __init__(self, door_properties, rep, location):
         GridElement.__init__(self, rep, location)
         self.prob = door_properties['prob']
+        # doors never change once read; their state while simulating is
+        # a bit of Environment.door_mask
         self.is_open = door_properties['is_open']
         self.is_open_original = door_properties['is_open']
 
@@ -52,46 +59,137 @@ class Door(GridElement):
 # ------------------------------
 class GridWorld():
     def __init__(self, prob_door, time_limit = 10):
+        self.name = 'grid'  # names saved screenshots and trial directories
         self.width = 0
         self.height = 0
         self.time_limit = time_limit
         self.prob_door = prob_door
         self.objects = []
+        self.index_objects()
+        self.compiled = None
+
 
+    def read_world(self, filename, cache_dir = None):
+        self.name = str(filename)
+        with open('grids/{}.txt'.format(filename), 'rb') as file:
+            self.parse_world(file.read().decode(), cache_dir)
+
+
+    def parse_world(self, text, cache_dir = None):
+        """ Builds the world from the contents of a grids/*.txt file """
+        if cache_dir is not None:
+            # Compiled worlds are keyed by file content, so edited grids miss
+            digest = hashlib.sha256(COMPILED_VERSION + text.encode()).hexdigest()
+            cache_path = os.path.join(cache_dir, digest + '.npz')
+            if os.path.exists(cache_path):
+                self.load_compiled(cache_path)
+                return
 
-    def read_world(self, filename):
         x = 0
         y = 0
-        with open('grids/{}.txt'.format(filename), 'r') as file:
-            phase = 1
-            doors = []
-            door_count = 0
-            for line in file:
-                line = line.strip('\n')
-                if line == '':
-                    phase += 1
-
-                # PHASE 1: Read in and store door properties
-                elif phase == 1:
-                    l = line.split(' ')
-                    doors.append({'prob': self.prob_door,
-                                  'is_open': (int(l[0]) == 1)})
-                
-                # PHASE 2: Read in actual grid world setup
-                elif phase == 2:
-                    for x, rep in enumerate(line):
-                        if rep == '.':
-                            continue
-                        if rep == '|':
-                            newobj = Door(doors[door_count], rep, (x//2 + 1, y))
-                            door_count += 1
-                        elif rep in rep_to_name:
-                            newobj = GridElement(rep, (x//2, y))
-                        self.objects.append(newobj)
-                    y += 1
+        phase = 1
+        doors = []
+        door_count = 0
+        for line in text.splitlines():
+            if line == '':
+                phase += 1
+
+            # PHASE 1: Read in and store door properties
+            elif phase == 1:
+                l = line.split(' ')
+                doors.append({'prob': self.prob_door,
+                              'is_open': (int(l[0]) == 1)})
+            
+            # PHASE 2: Read in actual grid world setup
+            elif phase == 2:
+                for x, rep in enumerate(line):
+                    if rep == '.':
+                        continue
+                    if rep == '|':
+                        newobj = Door(doors[door_count], rep, (x//2 + 1, y))
+                        door_count += 1
+                    elif rep in rep_to_name:
+                        newobj = GridElement(rep, (x//2, y))
+                    self.objects.append(newobj)
+                y += 1
 
         self.width = x//2 + 1
         self.height = y
+        self.index_objects()
+        self.compiled = None
+
+        if cache_dir is not None:
+            self.save_compiled(cache_path)
+
+
+    def save_compiled(self, path):
+        """ Saves the parsed layout and the compiled tables to one file """
+        arrays = self.compile().to_arrays()
+        arrays['object_reps'] = np.array([ord(o.rep) for o in self.objects],
+                                         dtype=np.uint8)
+        arrays['object_locations'] = np.array([o.location for o in self.objects],
+                                              dtype=np.int64).reshape(-1, 2)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = '{}.{}.tmp.npz'.format(path, os.getpid())
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+
+    def load_compiled(self, path):
+        """ Restores a world saved with save_compiled without parsing it """
+        with np.load(path) as data:
+            arrays = dict(data)
+        door_open = iter(arrays['door_open'].tolist())
+        self.objects = []
+        for rep, location in zip(arrays['object_reps'].tolist(),
+                                 arrays['object_locations'].tolist()):
+            rep = chr(rep)
+            if rep == Rep.DOOR:
+                door_properties = {'prob': self.prob_door, 'is_open': next(door_open)}
+                self.objects.append(Door(door_properties, rep, tuple(location)))
+            else:
+                self.objects.append(GridElement(rep, tuple(location)))
+        self.width = int(arrays['width'])
+        self.height = int(arrays['height'])
+        self.index_objects()
+        self.compiled = CompiledGrid.from_arrays(arrays, self)
+
+
+    def index_objects(self):
+        """ Builds location-keyed lookups so queries don't scan self.objects """
+        self.gridsquares = {}
+        self.doors = []
+        self.door_index = {}
+        self.door_bits_at = {}
+        self.initial_door_mask = 0
+        door_at = {}
+        self.start_locations = {}
+        self.goal_location = None
+        for o in self.objects:
+            if isinstance(o, Door):
+                self.door_index[o] = len(self.doors)
+                self.door_bits_at[o.location] = \
+                    self.door_bits_at.get(o.location, 0) | 1 << len(self.doors)
+                if o.is_open_original:
+                    self.initial_door_mask |= 1 << len(self.doors)
+                self.doors.append(o)
+                door_at.setdefault(o.location, o)
+                continue
+            # the first non-floor object at a location takes precedence
+            current = self.gridsquares.get(o.location)
+            if current is None or (current.name == 'Floor' and o.name != 'Floor'):
+                self.gridsquares[o.location] = o
+            if o.name == 'Start':
+                self.start_locations.setdefault(o.color, o.location)
+            elif o.name == 'Goal' and self.goal_location is None:
+                self.goal_location = o.location
+
+        self.doors_right_of = {}
+        for location in self.get_all_locations():
+            d = door_at.get(self.get_new_location(location, RIGHT))
+            if d is not None:
+                self.doors_right_of[location] = d
+        self.policies = {}
 
 
     def print(self):
@@ -100,23 +198,11 @@ class GridWorld():
 
 
     def get_gridsquare_at(self, location):
-        gridsquares = list(filter(lambda o: o.location == location and not\
-            isinstance(o, Door), self.objects))
-        not_floors = list(filter(lambda o: o.name != 'Floor', gridsquares))
-        if len(not_floors) > 0:
-            return not_floors[0]
-        if len(gridsquares) > 0:
-            return gridsquares[0]
-        return None
+        return self.gridsquares.get(location)
 
 
     def get_door_right_of(self, location):
-        if location[0] < self.width:
-            location_right = self.get_new_location(location, RIGHT) 
-            d = list(filter(lambda d: d.location == location_right,
-                            self.get_doors()))
-            if len(d) > 0: return d[0]
-        return None
+        return self.doors_right_of.get(location)
         
 
     def inbounds(self, location):
@@ -133,20 +219,15 @@ class GridWorld():
 
     
     def get_start_location(self, color):
-        starts = list(filter(lambda o: o.name == 'Start' and\
-            o.color == str_to_color(color), self.objects))
-        if len(starts) > 0: return starts[0].location
-        return (0, 0)
+        return self.start_locations.get(str_to_color(color), (0, 0))
             
 
     def get_goal_location(self):
-        goals = list(filter(lambda o: o.name == 'Goal', self.objects))
-        if len(goals) > 0: return goals[0].location
-        return None
+        return self.goal_location
 
 
     def get_doors(self):
-        return list(filter(lambda o: isinstance(o, Door), self.objects))
+        return self.doors
 
     
     def is_valid_action(self, location, action):
@@ -162,28 +243,61 @@ class GridWorld():
         return True
 
 
-    def make_reachability_graph(self):
-        self.reachability_graph = nx.Graph()
-        for location in self.get_all_locations():
-            self.reachability_graph.add_node(location)
-            actions = [DOWN, UP, LEFT, RIGHT]
-            for action in actions:
-                if self.is_valid_action(location, action):
-                    new_location = self.get_new_location(location, action)
-                    if new_location in self.reachability_graph:
-                        self.reachability_graph.add_edge(location, new_location)
+    def compile(self):
+        """ Returns the array form of this world, built once and then reused """
+        # Walls are static (doors are handled when executing), so everything
+        # derived from the layout can be shared by all simulations
+        if self.compiled is None:
+            self.compiled = CompiledGrid(self)
+        return self.compiled
+
+
+    def compile_door_changes(self, door_changes, time_limit = None):
+        """ Turns a trial's door_changes into a list indexed by timestep of
+        bitmasks over get_doors(), so replaying a step is a single XOR """
+        if time_limit is None:
+            time_limit = self.time_limit
+        schedule = [0] * (time_limit + 1)
+        for t, locations in door_changes.items():
+            if int(t) > time_limit:
+                continue
+            for location in locations:
+                # a door listed twice in one step still only changes once
+                schedule[int(t)] |= self.door_bits_at.get(tuple(location), 0)
+        return schedule
+
+
+    def get_policy(self, start):
+        """ Tabulates where an agent starting at start moves next from each
+        location on its shortest path to the goal, built once per start and
+        shared by every environment. The agent never leaves that path, so
+        following the table is the same as following the path """
+        if start not in self.policies:
+            self.policies[start] = {}
+            path = None
+            if self.goal_location is not None:
+                path = self.get_shortest_path(start, self.goal_location)
+            for location, next_location in zip(path or [], (path or [])[1:]):
+                # The path can cut through a blocked square, which the agent
+                # can never enter, so it stays stuck in front of it
+                action = get_action_from_location(location, next_location)
+                if not self.is_valid_action(location, action):
+                    break
+                self.policies[start][location] = next_location
+        return self.policies[start]
 
 
     def get_gridsquares_between(self, location_one, location_two):
-        self.make_reachability_graph()
-        try:
-            return nx.shortest_path_length(self.reachability_graph, location_one, location_two)
-        except nx.NetworkXNoPath:
-            pass
+        compiled = self.compile()
+        distances = compiled.distances(compiled.cell(location_two))
+        distance = int(distances[compiled.cell(location_one)])
+        return distance if distance >= 0 else None
+
             
     def get_shortest_path(self, location_one, location_two):
-        self.make_reachability_graph()
-        try:
-            return nx.shortest_path(self.reachability_graph, location_one, location_two)
-        except nx.NetworkXNoPath:
-            pass
+        compiled = self.compile()
+        path = compiled.shortest_path(compiled.cell(location_one),
+                                      compiled.cell(location_two))
+        if path is None:
+            return None
+        return [compiled.locations[cell] for cell in path]
@@ -0,0 +1,43 @@
+import sys
+import argparse
+import subprocess
+
+
+# Simulating must not need any of these, so worker processes start quickly
+HEAVY_MODULES = ['pygame', 'scipy', 'imageio', 'networkx']
+CORE_MODULES = ['agent', 'gridworld', 'environment', 'models', 'main', 'raster']
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser("import time benchmark argument parser")
+
+    parser.add_argument('--modules', nargs='+', default=CORE_MODULES, help='modules to time importing')
+    parser.add_argument('--repeats', type=int, default=5, help='number of fresh interpreters to time each import in, keeping the fastest')
+
+    return parser.parse_args()
+
+
+def time_import(module):
+    """ Imports module in a fresh interpreter, returning the seconds it took
+    and which heavy modules it loaded """
+    code = ('import sys, time\n'
+            'start = time.perf_counter()\n'
+            'import {}\n'
+            'print(time.perf_counter() - start)\n'
+            'print(",".join(m for m in {} if m in sys.modules))').format(module, HEAVY_MODULES)
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True,
+                            text=True, check=True).stdout.split('\n')
+    return float(output[0]), [m for m in output[1].split(',') if m != '']
+
+
+if __name__ == '__main__':
+    arglist = parse_arguments()
+    failed = False
+    for module in arglist.modules:
+        results = [time_import(module) for i in range(arglist.repeats)]
+        seconds = min(r[0] for r in results)
+        loaded = results[0][1]
+        print('{:12s} {:7.1f} ms{}'.format(module, seconds * 1000,
+              '  loads ' + ', '.join(loaded) if len(loaded) > 0 else ''))
+        failed = failed or len(loaded) > 0
+    sys.exit(1 if failed else 0)
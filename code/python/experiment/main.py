@@ -2,7 +2,8 @@ from environment import *
 from gridworld import *
 from agent import *
 from models import *
-from game import *
+from cache import ResultCache, file_hash, rng_state_hash
+from checkpoint import Checkpoint
 
 import os
 from collections import defaultdict
@@ -10,7 +11,10 @@ import csv
 import sys
 import argparse
 import numpy as np
+import json
 import random
+import hashlib
+import multiprocessing
 
 
 
@@ -21,7 +25,10 @@ def parse_arguments():
     parser.add_argument('--trial', type=int, default=0, help = 'which trial to generate specifically')
     parser.add_argument('--cf', action='store_true', default=False, help='run counterfactual model predictions')
     parser.add_argument('--hyp', action='store_true', default=False, help='run hypothetical model predictions')
+    parser.add_argument('--actual', action='store_true', default=False, help='run hypothetical model predictions for the path the agent actually took')
     parser.add_argument('--visualize', action='store_true', default=False, help='run pygame animations and make gif')
+    parser.add_argument('--no-frames', action='store_true', default=False, help='don\'t save a png of every frame while visualizing')
+    parser.add_argument('--video-format', choices=['gif', 'mp4', 'none'], default='gif', help='format of the video of each visualized trial (mp4 needs imageio-ffmpeg)')
     parser.add_argument('--verbose', action='store_true', default=False, help='verbosely print info while simulating or not')
     parser.add_argument('--save-trial-data', action='store_true', default=False, help='save trial data while generating trials')
     
@@ -29,10 +36,39 @@ def parse_arguments():
     parser.add_argument('--prob-stall', type=float, default=0.12, help='probabilty of agent stalling on any time step')
     parser.add_argument('--prob-door', type=float, default=0.19, help='probability of door switching on any time step')
     parser.add_argument('--time-limit', type=int, default=10, help='time limit for agent')
+    parser.add_argument('--adaptive', action='store_true', default=False, help='stop simulating once the confidence interval is narrow enough, using --n-simulations as the budget')
+    parser.add_argument('--ci-half-width', type=float, default=0.01, help='target half-width of the confidence interval on the success rate')
+    parser.add_argument('--ci-method', choices=['wilson', 'clopper-pearson'], default='wilson', help='type of confidence interval for --adaptive')
+    parser.add_argument('--crn', action='store_true', default=False, help='simulate all models of a trial on common random numbers and save their paired differences')
+    parser.add_argument('--antithetic', action='store_true', default=False, help='pair each simulation with a mirrored one when using --crn')
+    parser.add_argument('--world-cache', type=str, default=None, help='directory of compiled grid worlds to load instead of parsing grids')
+    parser.add_argument('--cache', type=str, default=None, help='sqlite file to reuse model results from across runs')
+    parser.add_argument('--cache-size', type=float, default=64, help='size limit of the result cache in megabytes')
+    parser.add_argument('--seed', type=int, default=None, help='give each (trial, model) pair, or each trial with --crn, its own random stream spawned from this seed instead of the global stream seeded by trial number')
+    parser.add_argument('--jobs', type=int, default=0, help='run each trial\'s models as a work unit across this many processes, which also share visualizing trials and making images')
+    parser.add_argument('--checkpoint-dir', type=str, default=None, help='directory to periodically save each model run\'s progress to')
+    parser.add_argument('--checkpoint-interval', type=float, default=60, help='minimum number of seconds between checkpoints of a model run')
+    parser.add_argument('--resume', action='store_true', default=False, help='continue from the checkpoints in --checkpoint-dir instead of starting over')
+    parser.add_argument('--engine', choices=['loop', 'batch', 'exact'], default='loop', help='simulate episodes one at a time, vectorized in numpy, or compute exact success rates')
 
     parser.add_argument('--make-image', action='store_true', default=False, help='just make image of grid')
 
-    return parser.parse_args()
+    arglist = parser.parse_args()
+    if arglist.adaptive and arglist.engine == 'exact':
+        parser.error('--adaptive needs a simulating engine, not --engine exact')
+    if arglist.adaptive and arglist.n_simulations < 1:
+        parser.error('--adaptive needs a budget of at least 1 simulation')
+    # --crn always steps models together with the batch engine, which plays
+    # the same episodes as the loop engine
+    if arglist.crn and arglist.adaptive:
+        parser.error('--crn runs a fixed number of simulations and can\'t be combined with --adaptive')
+    if arglist.crn and arglist.engine == 'exact':
+        parser.error('--crn simulates and can\'t be combined with --engine exact')
+    if arglist.antithetic and not arglist.crn:
+        parser.error('--antithetic only applies to --crn')
+    if arglist.antithetic and arglist.n_simulations % 2 != 0:
+        parser.error('--antithetic needs an even --n-simulations')
+    return arglist
 
 
 def fix_seed(seed):
@@ -40,25 +76,221 @@ def fix_seed(seed):
     random.seed(seed)
 
 
+# Arguments that change model results, and so key cached results and checkpoints
+MODEL_PARAMS = ['n_simulations', 'prob_stall', 'prob_door', 'time_limit', 'engine',
+                'adaptive', 'ci_half_width', 'ci_method', 'crn', 'antithetic', 'seed']
+
+
+# Fixed stream keys, so adding or dropping a model leaves the others' draws alone
+MODEL_KEYS = {'cf': 0, 'hyp': 1, 'actual': 2}
+
+
+def make_rng(arglist, *spawn_key):
+    """ Returns the unit's own stream with --seed, or None for the global one """
+    if arglist.seed is None:
+        return None
+    return spawn_rng(arglist.seed, *spawn_key)
+
+
+def make_env(trial, arglist):
+    gw = GridWorld(arglist.prob_door, arglist.time_limit)
+    cache_dir = getattr(arglist, 'world_cache', None)
+    if 'grid' in trial:
+        # generated trials carry their grid instead of a file in grids/
+        gw.parse_world(trial['grid'], cache_dir = cache_dir)
+    else:
+        gw.read_world(filename = str(trial['num']), cache_dir = cache_dir)
+    a = Agent(path = trial['path'], prob_stall = arglist.prob_stall)
+    return Environment(gw, a, generating_trials = True,
+                       trial_dir = 'trials/' + str(trial['num']))
+
+
+def make_model(env, model_type, trial, original_runtime):
+    if model_type == 'cf':
+        return CounterfactualModel(env, 'counterfactual', original_runtime,
+                                   door_changes = trial['door_changes'])
+    if model_type == 'actual':
+        return Model(env, 'actual', opposite_path = False)
+    return HypotheticalModel(env, 'hypothetical')
+
+
+def run_model(env, model_type, trial, original_runtime, arglist,
+              checkpoint = None):
+    """ Runs a model and returns its columns for experiment.csv """
+    model = make_model(env, model_type, trial, original_runtime)
+    rng = make_rng(arglist, trial['num'], MODEL_KEYS[model_type])
+    if arglist.adaptive:
+        rate, (low, high), n = model.simulate_adaptive(
+            half_width = arglist.ci_half_width,
+            max_simulations = arglist.n_simulations, engine = arglist.engine,
+            method = arglist.ci_method, rng = rng, checkpoint = checkpoint)
+        return {model_type + '_success_rate': round(rate * 100, 2),
+                model_type + '_ci_low': round(low * 100, 2),
+                model_type + '_ci_high': round(high * 100, 2),
+                model_type + '_n_simulations': n}
+    rate = model.simulate_all(num_simulations = arglist.n_simulations,
+                              verbose = arglist.verbose,
+                              engine = arglist.engine, rng = rng,
+                              checkpoint = checkpoint)
+    return {model_type + '_success_rate': rate}
+
+
+def run_paired(env, model_types, trial, original_runtime, arglist,
+               checkpoint = None):
+    """ Runs a trial's models on common random numbers and returns their
+    columns for experiment.csv, including all paired differences """
+    models = [make_model(env, t, trial, original_runtime) for t in model_types]
+    won = simulate_paired(models, arglist.n_simulations,
+                          antithetic = arglist.antithetic,
+                          rng = make_rng(arglist, trial['num']),
+                          checkpoint = checkpoint)
+    columns = {}
+    for model_type, model_won in zip(model_types, won):
+        columns[model_type + '_success_rate'] = int(model_won.mean() * 100)
+    for i in range(len(model_types)):
+        for j in range(i + 1, len(model_types)):
+            diff, se = paired_difference(won[i], won[j], arglist.antithetic)
+            name = '{}_minus_{}'.format(model_types[i], model_types[j])
+            columns[name] = round(diff * 100, 2)
+            columns[name + '_se'] = round(se * 100, 2)
+            print('{} difference was {:.2f}% (se {:.2f}%) across {} paired simulations'.format(
+                  name, diff * 100, se * 100, arglist.n_simulations))
+    return columns
+
+
+def run_models(env, model_types, trial, original_runtime, arglist):
+    """ Runs models together, serving their results from the cache if set """
+    if arglist.cache is None:
+        return compute_models(env, model_types, trial, original_runtime, arglist)
+
+    # Without --seed, models continue the global stream left by earlier ones,
+    # so its state is part of the key and the state after the run is restored
+    cache = ResultCache(arglist.cache, int(arglist.cache_size * 2**20))
+    uses_rng = arglist.seed is None and \
+        (arglist.engine != 'exact' or arglist.adaptive or arglist.crn)
+    key = cache.key(grid = file_hash('grids/{}.txt'.format(trial['num'])),
+                    trial = trial, original_runtime = original_runtime,
+                    models = model_types,
+                    params = {p: getattr(arglist, p) for p in MODEL_PARAMS},
+                    rng_state = rng_state_hash() if uses_rng else None)
+    hit = cache.get(key)
+    if hit is not None:
+        columns, rng_state = hit
+        np.random.set_state(rng_state)
+        print('loaded {} results for trial {} from cache'.format(
+              ', '.join(model_types), trial['num']))
+    else:
+        columns = compute_models(env, model_types, trial, original_runtime, arglist)
+        cache.put(key, columns, np.random.get_state())
+    cache.close()
+    return columns
+
+
+def open_checkpoint(model_types, trial, arglist):
+    """ Returns the checkpoint of a unit of models, or None without --checkpoint-dir """
+    if arglist.checkpoint_dir is None:
+        return None
+    os.makedirs(arglist.checkpoint_dir, exist_ok=True)
+    # Keyed like cached results, so changed arguments never resume old progress
+    key = json.dumps({'trial': trial, 'models': model_types,
+                      'params': {p: getattr(arglist, p) for p in MODEL_PARAMS}},
+                     sort_keys=True)
+    name = 'trial{}_{}_{}.pkl'.format(trial['num'], '-'.join(model_types),
+                                      hashlib.sha256(key.encode()).hexdigest()[:16])
+    return Checkpoint(os.path.join(arglist.checkpoint_dir, name),
+                      arglist.checkpoint_interval, arglist.resume)
+
+
+def compute_models(env, model_types, trial, original_runtime, arglist):
+    # A finished unit restores where it left the global stream, which the
+    # next model of the trial continues from
+    checkpoint = open_checkpoint(model_types, trial, arglist)
+    if checkpoint is not None and checkpoint.done():
+        checkpoint.restore()
+        print('loaded {} results for trial {} from checkpoint'.format(
+              ', '.join(model_types), trial['num']))
+        return checkpoint.state['columns']
+
+    if arglist.crn:
+        columns = run_paired(env, model_types, trial, original_runtime, arglist,
+                             checkpoint)
+    else:
+        # only single model runs save progress part way through
+        columns = {}
+        for model_type in model_types:
+            columns.update(run_model(env, model_type, trial, original_runtime,
+                                     arglist, checkpoint if len(model_types) == 1 else None))
+    if checkpoint is not None:
+        checkpoint.finish(columns)
+    return columns
+
+
+def run_trial(env, trial, arglist, visualize):
+    """ Runs the agent through the trial's recorded door changes, returning
+    its runtime and outcome """
+    return env.run(door_changes = trial['door_changes'], verbose = arglist.verbose,
+        visualize = visualize, save_frames = not arglist.no_frames,
+        video_format = None if arglist.video_format == 'none' else arglist.video_format)
+
+
+def visualize_unit(unit):
+    """ Visualizes one trial in a worker, which has its own headless game.
+    The recorded run draws no random numbers, so its frames are the same as
+    in the main process """
+    trial, arglist = unit
+    run_trial(make_env(trial, arglist), trial, arglist, visualize = True)
+    return trial['num']
+
+
+def make_image(unit):
+    """ Saves an image of a trial's grid in grid_images/ """
+    trial_num, arglist = unit
+    from game import Game  # only rendering needs pygame
+    gw = GridWorld(prob_door = arglist.prob_door, time_limit = 1)
+    gw.read_world(filename = trial_num, cache_dir = arglist.world_cache)
+    g = Game(gw, agent = None)
+    g.on_init(no_sidebar = True, headless = True)
+    g.on_render()
+    g.screenshot('grid_images/{}.png'.format(trial_num))
+    g.on_cleanup()
+    return trial_num
+
+
+def run_units(function, units, jobs):
+    """ Maps function over units across a pool of jobs processes, or here in turn """
+    if jobs > 0 and len(units) > 0:
+        with multiprocessing.Pool(jobs) as pool:
+            return pool.map(function, units)
+    return [function(unit) for unit in units]
+
+
+def run_model_unit(unit):
+    """ Runs all of a trial's models in a worker. It seeds and runs them in
+    the same order as the main process does, so later models continue the
+    earlier ones' random stream just as in a run without --jobs """
+    trial, groups, original_runtime, arglist = unit
+    fix_seed(trial['num'])
+    env = make_env(trial, arglist)
+    columns = {}
+    for group in groups:
+        columns.update(run_models(env, group, trial, original_runtime, arglist))
+    return trial['num'], columns
+
+
 if __name__ == '__main__':
     arglist = parse_arguments()
 
     if arglist.make_image:
-        if arglist.trial == 0:
-            print('please specify a valid trial number with --trial')
-            import sys; sys.exit(0)
-
-        gw = GridWorld(prob_door = arglist.prob_door, time_limit = 1)
-        gw.read_world(filename = arglist.trial)
-        g = Game(gw, agent = None)
-        g.on_init(no_sidebar = True)
-        g.on_render()
-        g.screenshot('grid_images/{}.png'.format(arglist.trial))
-        g.on_cleanup()
+        # every trial's grid unless one is given
+        trial_nums = [arglist.trial] if arglist.trial > 0 else \
+            [trial['num'] for trial in read_trials()]
+        run_units(make_image, [(num, arglist) for num in trial_nums], arglist.jobs)
 
     elif arglist.generate_trials:
         trials = read_trials()
         trial_data = []
+        units = []
+        visualize_units = []
 
         for trial in trials:
             trial_num = trial['num']
@@ -67,36 +299,44 @@ if __name__ == '__main__':
                 continue
 
             print('\n----- generating trial {} -----\n'.format(trial_num))
-            gw = GridWorld(arglist.prob_door)
-            gw.read_world(filename = str(trial_num))
             this_trial_data = {'trial': trial_num}
-            trial_dir = 'trials/' + str(trial_num)
-
-            a = Agent(path = trial['path'], prob_stall = arglist.prob_stall)
 
-            # Run agent baseline and record outcome
-            env = Environment(gw, a, generating_trials = True, trial_dir = trial_dir)
-            original_runtime, outcome = env.run(door_changes = trial['door_changes'],
-                verbose = arglist.verbose, visualize = arglist.visualize)
+            # Run agent baseline and record outcome, leaving visualizing
+            # to the process pool if there is one
+            env = make_env(trial, arglist)
+            original_runtime, outcome = run_trial(env, trial, arglist,
+                visualize = arglist.visualize and arglist.jobs == 0)
             this_trial_data['outcome'] = outcome
+            if arglist.visualize and arglist.jobs > 0:
+                visualize_units.append((trial, arglist))
 
-            # Run counterfactual model and record success rate
-            if arglist.cf:
-                cf = CounterfactualModel(env, 'counterfactual', original_runtime,
-                                         door_changes = trial['door_changes'])
-                rate = cf.simulate_all(num_simulations = arglist.n_simulations,
-                                       verbose = arglist.verbose)
-                this_trial_data['cf_success_rate'] = rate
-
-            # Run hypothetical model and record success rate
-            if arglist.hyp:
-                hyp = HypotheticalModel(env, 'hypothetical')
-                rate = hyp.simulate_all(num_simulations = arglist.n_simulations,
-                                        verbose = arglist.verbose)
-                this_trial_data['hyp_success_rate'] = rate
+            # Models on common random numbers have to run together
+            model_types = [t for t in ['cf', 'hyp', 'actual'] if getattr(arglist, t)]
+            if arglist.crn:
+                groups = [model_types] if len(model_types) > 0 else []
+            else:
+                groups = [[t] for t in model_types]
+
+            # Queue the trial's models for the process pool, or run them here in turn
+            if arglist.jobs > 0:
+                if len(groups) > 0:
+                    units.append((trial, groups, original_runtime, arglist))
+            else:
+                for group in groups:
+                    this_trial_data.update(run_models(env, group, trial,
+                                                      original_runtime, arglist))
             
             trial_data.append(this_trial_data)
 
+        # Each trial reseeds from its trial number, so results are identical
+        # no matter how many workers share them
+        run_units(visualize_unit, visualize_units, arglist.jobs)
+        if len(units) > 0:
+            results = run_units(run_model_unit, units, arglist.jobs)
+            rows = {row['trial']: row for row in trial_data}
+            for trial_num, columns in results:
+                rows[trial_num].update(columns)
+
         # Save model predictions
         if arglist.save_trial_data:
             with open('../../experiment/experiment.csv', 'w') as outfile:
@@ -1,39 +1,278 @@
 from utils import opp_color
+from agent import Agent
+from batch import BatchSimulator, draw_blocks, draw_uniforms
 
 import copy
+import numpy as np
+from statistics import NormalDist
+
+
+def wilson_interval(num_successes, num_simulations, confidence = 0.95):
+    z = NormalDist().inv_cdf(1 - (1 - confidence) / 2)
+    p = num_successes / num_simulations
+    denominator = 1 + z**2 / num_simulations
+    center = (p + z**2 / (2 * num_simulations)) / denominator
+    margin = z / denominator * np.sqrt(p * (1 - p) / num_simulations +\
+                                       z**2 / (4 * num_simulations**2))
+    return max(center - margin, 0.), min(center + margin, 1.)
+
+
+def clopper_pearson_interval(num_successes, num_simulations, confidence = 0.95):
+    from scipy.stats import beta
+    alpha = 1 - confidence
+    k, n = num_successes, num_simulations
+    low = beta.ppf(alpha / 2, k, n - k + 1) if k > 0 else 0.
+    high = beta.ppf(1 - alpha / 2, k + 1, n - k) if k < n else 1.
+    return float(low), float(high)
+
+
+def confidence_interval(num_successes, num_simulations, method = 'wilson',
+                        confidence = 0.95):
+    if method == 'clopper-pearson':
+        return clopper_pearson_interval(num_successes, num_simulations, confidence)
+    return wilson_interval(num_successes, num_simulations, confidence)
+
+
+
+def simulate_paired(models, num_simulations, antithetic = False, rng = None,
+                    chunk_size = 65536, checkpoint = None):
+    """ Simulates models of the same world on common random numbers, so
+    each simulation uses the same stall and door-flip draws for all of them.
+    Returns a (models, simulations) array of won flags. With checkpoint, the
+    flags so far are saved between chunks and resumed from """
+    sims = [m.batch_simulator() for m in models]
+    grid = sims[0].grid
+    won = np.zeros((len(models), num_simulations), dtype=bool)
+    first = 0
+    if checkpoint is not None:
+        won_so_far, first = checkpoint.restore(rng)
+        if first > 0:
+            won[:, :first] = won_so_far
+    for start in range(first, num_simulations, chunk_size):
+        if checkpoint is not None and start > first:
+            checkpoint.save(won[:, :start], start, rng)
+        end = min(start + chunk_size, num_simulations)
+        uniforms = draw_uniforms(end - start, grid.time_limit, grid.num_doors,
+                                 rng, antithetic)
+        for i, sim in enumerate(sims):
+            won[i, start:end] = sim.run_chunk(end - start, uniforms = uniforms)[0]
+    return won
+
+
+def paired_difference(won_one, won_two, antithetic = False):
+    """ Returns the mean paired difference in success and its standard error """
+    diffs = won_one.astype(float) - won_two
+    if antithetic:
+        # mirrored episodes are dependent, so average each pair first
+        diffs = diffs.reshape(-1, 2).mean(axis=1)
+    return diffs.mean(), diffs.std(ddof=1) / np.sqrt(len(diffs))
+
+
+def log_ratio(count, prob, base_prob):
+    """ Returns count * log(prob / base_prob) for arrays of counts, taking
+    0 * log(0) as 0 so probabilities of 0 and 1 are allowed """
+    if prob == 0:
+        return np.where(count == 0, 0., -np.inf)
+    return count * np.log(prob / base_prob)
+
+
+def exact_success_probability(sim):
+    """ Computes a batch simulator's exact success probability by propagating
+    the distribution over (path cursor, door states) through each timestep """
+    if sim.path is None:
+        return 0.
+    num_doors = len(sim.doors)
+    if num_doors > 20:
+        raise ValueError('exact inference supports at most 20 doors on a path')
+
+    goal = len(sim.path) - 1
+    masks = np.arange(2 ** num_doors)
+    bits = np.maximum(sim.door_bit, 0)[:, None]
+    blocked = ((sim.door_bit[:, None] >= 0) & ((masks >> bits) & 1 == 0)) | \
+        sim.stuck[:, None]
+    move_prob = (1 - sim.prob_stall) * ~blocked[:-1]
+
+    prob = np.zeros((goal + 1, masks.size))
+    prob[0, int(sim.initial_mask)] = 1.
+    success = 0.
+    for t in range(1, sim.time_limit + 1):
+        moved = prob[:-1] * move_prob
+        prob[:-1] -= moved
+        prob[1:] += moved
+
+        if t <= sim.original_runtime:
+            prob = prob[:, masks ^ int(sim.schedule[t])]
+        else:
+            for i, p in enumerate(sim.door_probs):
+                prob = (1 - p) * prob + p * prob[:, masks ^ (1 << i)]
+
+        success += prob[goal].sum()
+        prob[goal] = 0.
+    return success
 
 
 class Model:
-    def __init__(self, env, model_type, original_runtime = 0, door_changes = {}):
-        self.env = copy.deepcopy(env) # copy over agent and gridworld
+    def __init__(self, env, model_type, original_runtime = 0, door_changes = {},
+                 opposite_path = True):
+        # Simulating never changes the world, so models share it and only
+        # get their own agent and state
+        self.env = copy.copy(env)
         self.env.generating_trials = False
+        # Initialize cf/hyp agent to be the opposite
+        path = opp_color(env.agent.path) if opposite_path else env.agent.path
+        self.env.agent = Agent(path, env.agent.prob_stall)
+        self.env.reset()
         self.model_type = model_type # counterfactual or hypothetical
         self.original_runtime = original_runtime
         self.door_changes = door_changes
+        self.schedule = self.env.world.compile_door_changes(door_changes)
    
 
-    def simulate_once(self, verbose):
-        self.env.reset()
-        _, outcome = self.env.run(door_changes = self.door_changes,
-                original_runtime = self.original_runtime, verbose = verbose)
+    def simulate_once(self, verbose, uniforms = None):
+        _, outcome = self.env.run(schedule = self.schedule,
+                original_runtime = self.original_runtime, verbose = verbose,
+                uniforms = uniforms)
         return outcome == 'won'
 
 
-    def simulate_all(self, num_simulations, verbose = False):
-        # Initialize cf/hyp agent to be the opposite
-        self.env.agent.path = opp_color(self.env.agent.path)
+    def simulate_loop(self, num_simulations, rng = None, verbose = False,
+                      block_size = 1000, checkpoint = None):
+        """ Runs episodes one at a time and returns the number won. With rng,
+        episodes consume pre-drawn blocks from it in bulk, matching the batch
+        engine on the same stream; without, they draw from the global one.
+        With checkpoint, progress is saved between blocks and resumed from """
+        num_successes, start = checkpoint.restore(rng) if checkpoint else (0, 0)
+        for i in range(start, num_simulations):
+            if checkpoint is not None and i % block_size == 0 and i > start:
+                checkpoint.save(num_successes, i, rng)
+            if verbose:
+                print('simulation', i+1)
+            elif i > 0 and i % 100 == 0:
+                print(i, 'simulations done')
+            uniforms = None
+            if rng is not None:
+                if i % block_size == 0:
+                    blocks = draw_blocks(min(block_size, num_simulations - i),
+                                         self.env.world.time_limit,
+                                         len(self.env.world.get_doors()), rng)
+                uniforms = blocks[i % block_size]
+            num_successes += self.simulate_once(verbose, uniforms)
+        return num_successes
 
+
+    def batch_simulator(self, **overrides):
+        self.env.reset()
+        return BatchSimulator(self.env, self.door_changes, self.original_runtime,
+                              **overrides)
+
+
+    def simulate_batch(self, num_simulations, rng = None, checkpoint = None):
+        if checkpoint is None:
+            won, _ = self.batch_simulator().run(num_simulations, rng)
+            return int(won.sum())
+
+        # same chunks as BatchSimulator.run, saving progress between them
+        sim = self.batch_simulator()
+        num_successes, start = checkpoint.restore(rng)
+        for i in range(start, num_simulations, sim.chunk_size):
+            if i > start:
+                checkpoint.save(num_successes, i, rng)
+            won, _, _ = sim.run_chunk(min(sim.chunk_size, num_simulations - i), rng)
+            num_successes += int(won.sum())
+        return num_successes
+
+
+    def success_probability(self, **overrides):
+        """ Computes the exact success probability, optionally overriding
+        prob_stall, prob_door or time_limit """
+        return exact_success_probability(self.batch_simulator(**overrides))
+
+
+    def reweighted_success_rates(self, num_simulations, points, rng = None,
+                                 **overrides):
+        """ Estimates success rates at every (prob_stall, prob_door) point from
+        a single batch of simulations at the model's own parameters (or
+        overrides), weighting each episode by its likelihood ratio under the
+        point. Also returns each estimate's effective sample size """
+        sim = self.batch_simulator(**overrides)
+        base_stall = sim.prob_stall
+        base_door = sim.door_probs[0] if len(sim.doors) > 0 else 0.5
+        # every episode needs a nonzero probability under any point
+        if not (0 < base_stall < 1 and 0 < base_door < 1):
+            raise ValueError('reweighting needs base probabilities strictly between 0 and 1')
+        won, _, counts = sim.run(num_simulations, rng, return_counts = True)
+        stalls, stall_draws, flips, flip_draws = counts.T
+
+        results = []
+        for prob_stall, prob_door in points:
+            log_weights = log_ratio(stalls, prob_stall, base_stall) +\
+                log_ratio(stall_draws - stalls, 1 - prob_stall, 1 - base_stall) +\
+                log_ratio(flips, prob_door, base_door) +\
+                log_ratio(flip_draws - flips, 1 - prob_door, 1 - base_door)
+            weights = np.exp(log_weights)
+            # no episode is possible under the point when all weights are 0
+            total = weights.sum()
+            results.append({'prob_stall': prob_stall, 'prob_door': prob_door,
+                            'success_rate': np.mean(weights * won),
+                            'ess': total**2 / (weights**2).sum() if total > 0 else 0.})
+        return results
+
+
+    def simulate_adaptive(self, half_width, max_simulations, engine = 'loop',
+                          method = 'wilson', confidence = 0.95, batch_size = 1000,
+                          rng = None, checkpoint = None):
+        """ Simulates in batches until the confidence interval on the success
+        rate is within half_width on either side or the budget runs out. With
+        checkpoint, progress is saved between batches and resumed from """
+        if max_simulations < 1:
+            raise ValueError('adaptive simulation needs a budget of at least 1 simulation')
+        if engine not in ['loop', 'batch']:
+            raise ValueError('adaptive simulation needs the loop or batch engine')
+        print('running {} model with {} path...'.format(self.model_type,
+                self.env.agent.path))
+
+        num_successes, start = checkpoint.restore(rng) if checkpoint else (0, 0)
+        num_simulations = start
+        while num_simulations < max_simulations:
+            if checkpoint is not None and num_simulations > start:
+                checkpoint.save(num_successes, num_simulations, rng)
+            n = min(batch_size, max_simulations - num_simulations)
+            if engine == 'batch':
+                num_successes += self.simulate_batch(n, rng)
+            else:
+                num_successes += self.simulate_loop(n, rng)
+            num_simulations += n
+            low, high = confidence_interval(num_successes, num_simulations,
+                                            method, confidence)
+            if (high - low) / 2 <= half_width:
+                break
+
+        success_rate = num_successes / num_simulations
+        print('{} success rate on {} path was {:.2f}% ({:.2f}-{:.2f}%) across {} simulations\n'.format(
+               self.model_type, self.env.agent.path, success_rate * 100,
+               low * 100, high * 100, num_simulations))
+
+        return success_rate, (low, high), num_simulations
+
+
+    def simulate_all(self, num_simulations, verbose = False, engine = 'loop',
+                     rng = None, checkpoint = None):
         # Run simulations and track success rate
         num_successes = 0
         print('running {} model with {} path...'.format(self.model_type,
                 self.env.agent.path))
-        
-        for i in range(num_simulations):
-            if verbose:
-                print('simulation', i+1)
-            else:
-                if i > 0 and i % 100 == 0: print(i, 'simulations done')
-            num_successes += self.simulate_once(verbose)
+
+        if engine == 'exact':
+            success_rate = round(self.success_probability() * 100, 2)
+            print('{} success rate on {} path is exactly {}%\n'.format(
+                   self.model_type, self.env.agent.path, success_rate))
+            return success_rate
+
+        if engine == 'batch':
+            num_successes = self.simulate_batch(num_simulations, rng, checkpoint)
+        else:
+            num_successes = self.simulate_loop(num_simulations, rng, verbose,
+                                               checkpoint = checkpoint)
             
         success_rate = int(num_successes / num_simulations * 100)
         print('{} success rate on {} path was {}% across {} simulations\n'.format(
@@ -50,6 +289,6 @@ class CounterfactualModel(Model):
 
 
 class HypotheticalModel(Model):
-    def __init__(self, env, model_type):
-        Model.__init__(self, env, "hypothetical")
+    def __init__(self, env, model_type, opposite_path = True):
+        Model.__init__(self, env, "hypothetical", opposite_path = opposite_path)
 
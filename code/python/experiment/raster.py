@@ -0,0 +1,245 @@
+from utils import Color
+
+import numpy as np
+
+
+# Segments of each digit for the timer, as (x, y, width, height) in units of
+# the stroke: top, top left, top right, middle, bottom left, bottom right, bottom
+SEGMENTS = [(1, 0, 3, 1), (0, 1, 1, 3), (4, 1, 1, 3), (1, 4, 3, 1),
+            (0, 5, 1, 3), (4, 5, 1, 3), (1, 8, 3, 1)]
+DIGIT_SEGMENTS = ['012456', '25', '02346', '02356', '1235',
+                  '01356', '013456', '025', '0123456', '012356']
+
+
+def load_sprite(filename, size):
+    """ Loads an image from ../graphics and scales it like pygame.transform.scale,
+    returning its colors and alpha as integers in [0, 255] """
+    import imageio
+    image = np.asarray(imageio.v2.imread('../graphics/{}.png'.format(filename)))
+    if image.shape[2] == 3:
+        image = np.concatenate([image, np.full(image.shape[:2] + (1,), 255, np.uint8)], axis=2)
+    w, h = size
+    rows = np.arange(h) * image.shape[0] // h
+    cols = np.arange(w) * image.shape[1] // w
+    image = image[rows][:, cols].astype(np.int64)
+    return image[:, :, :3], image[:, :, 3]
+
+
+class Rasterizer:
+    """ Draws frames of a compiled world straight into numpy arrays, with the
+    layout of game.Game. Needs no pygame or display, so it can run alongside
+    simulations and in any number of worker processes """
+
+    def __init__(self, grid, no_sidebar = False):
+        self.grid = grid
+        self.no_sidebar = no_sidebar
+
+        # Same layout as game.Game
+        self.scale = 80
+        self.agent_r = 25
+        self.agent_start_center = (self.scale//2, self.scale*3//2)
+        self.eye_size = (16, 22)
+        self.eye_offsets = [(-16, -18), (1, -18)]
+        self.star_width = 60
+        self.star_offset = ((self.scale - self.star_width)//2,
+                            (self.scale - self.star_width)//2)
+        self.sidebar_left = self.scale
+        self.sidebar_right = self.scale * 2
+        self.wall_width = 7
+        self.door_width = 19
+        self.door_jut = self.scale//6
+        self.text_vspacing = 10
+        self.small_fsize = 18
+        self.stroke = 4  # of the timer's digits
+        self.width = self.scale * grid.width + self.wall_width
+        self.screen_width = self.width if no_sidebar else \
+            self.width + self.sidebar_left + self.sidebar_right
+        self.height = self.scale * grid.height + self.wall_width
+
+        self.render_static()
+        self.render_doors()
+        self.render_agent()
+
+
+    def top_left(self, location):
+        x = self.scale * location[0] + self.wall_width//2
+        y = self.scale * location[1] + self.wall_width//2
+        return (x, y) if self.no_sidebar else (x + self.sidebar_left, y)
+
+
+    def line_rect(self, start, diff, width):
+        """ Returns the (x0, y0, x1, y1) pixels an axis-aligned line of the
+        given width covers, end points included like pygame.draw.line """
+        end = np.add(start, diff)
+        x0, x1 = sorted([start[0], end[0]])
+        y0, y1 = sorted([start[1], end[1]])
+        if diff[0] == 0:
+            x0, x1 = x0 - width//2, x1 + width//2
+        else:
+            y0, y1 = y0 - width//2, y1 + width//2
+        return max(x0, 0), max(y0, 0), min(x1, self.screen_width - 1), \
+            min(y1, self.height - 1)
+
+
+    def render_static(self):
+        """ Draws the grid without doors into self.base, and the perimeter
+        walls (which cover the doors) into self.static on top of it """
+        base = np.empty((self.height, self.screen_width, 3), dtype=np.uint8)
+        base[:] = Color.WHITE
+        for location in self.grid.locations:
+            if location == (0, 1): continue
+            x, y = self.top_left(location)
+            base[y:y + self.scale, x:x + self.scale] = Color.LINE
+            base[y + 1:y + self.scale - 1, x + 1:x + self.scale - 1] = Color.FLOOR
+
+        self.fills = []
+        colors = {self.grid.start_cells['red']: Color.LIGHT_RED,
+                  self.grid.start_cells['blue']: Color.LIGHT_BLUE}
+        for cell in np.flatnonzero(self.grid.blocked).tolist() + list(colors):
+            x, y = self.top_left(self.grid.locations[cell])
+            base[y:y + self.scale, x:x + self.scale] = \
+                Color.BLACK if self.grid.blocked[cell] else colors[cell]
+            self.fills.append(cell)
+
+        if self.grid.goal >= 0:
+            star, alpha = load_sprite('goal', (self.star_width, self.star_width))
+            x, y = np.add(self.top_left(self.grid.locations[self.grid.goal]),
+                          self.star_offset)
+            self.blend(base[y:y + self.star_width, x:x + self.star_width], star, alpha)
+        self.base = base
+
+        w, h = self.grid.width, self.grid.height
+        self.walls = np.zeros((self.height, self.screen_width), dtype=bool)
+        for start, diff in [((0, 0), (self.scale * w, 0)), ((w, 0), (0, self.scale * h)),
+                            ((0, h), (self.scale * w, 0)), ((0, 1), (self.scale * (w - 1), 0)),
+                            ((w - 1, 1), (0, self.scale)), ((0, 2), (self.scale * (w - 1), 0))]:
+            x0, y0, x1, y1 = self.line_rect(self.top_left(start), diff, self.wall_width)
+            self.walls[y0:y1 + 1, x0:x1 + 1] = True
+        self.static = base.copy()
+        self.static[self.walls] = Color.WALL
+
+
+    def render_doors(self):
+        """ Pre-renders every door's area of the frame with the door closed
+        and open, so a frame only has to paste one of them per door """
+        self.doors = []
+        for d, location in enumerate(self.grid.door_locations):
+            tl = self.top_left(location)
+            closed = [self.line_rect(tl, (0, self.scale), self.door_width)]
+            opened = [self.line_rect(tl, (0, self.door_jut), self.door_width),
+                      self.line_rect((tl[0], tl[1] + self.scale), (0, -self.door_jut),
+                                     self.door_width)]
+            x0, y0 = min(r[0] for r in closed + opened), min(r[1] for r in closed + opened)
+            x1, y1 = max(r[2] for r in closed + opened), max(r[3] for r in closed + opened)
+
+            patches = []
+            for rects in [closed, opened]:
+                patch = self.base[y0:y1 + 1, x0:x1 + 1].copy()
+                for rx0, ry0, rx1, ry1 in rects:
+                    patch[ry0 - y0:ry1 - y0 + 1, rx0 - x0:rx1 - x0 + 1] = Color.DOOR
+                # Game draws grid objects in the order they appear in the
+                # grid file, so fills read after the door cover it
+                for cell in self.fills:
+                    cx, cy = self.grid.locations[cell]
+                    if cy > location[1] or (cy == location[1] and cx >= location[0]):
+                        fx, fy = self.top_left((cx, cy))
+                        fx0, fy0 = max(fx, x0), max(fy, y0)
+                        fx1 = min(fx + self.scale - 1, x1)
+                        fy1 = min(fy + self.scale - 1, y1)
+                        if fx0 <= fx1 and fy0 <= fy1:
+                            patch[fy0 - y0:fy1 - y0 + 1, fx0 - x0:fx1 - x0 + 1] = \
+                                self.base[fy0:fy1 + 1, fx0:fx1 + 1]
+                patch[self.walls[y0:y1 + 1, x0:x1 + 1]] = Color.WALL
+                patches.append(patch)
+            self.doors.append((slice(y0, y1 + 1), slice(x0, x1 + 1), np.stack(patches)))
+
+
+    def render_agent(self):
+        """ Draws the agent and its eyes once as a sprite centered on it """
+        r = self.agent_r
+        size = 2 * r + 1
+        yy, xx = np.mgrid[-r:r + 1, -r:r + 1]
+        distances = np.sqrt(xx**2 + yy**2)
+        self.agent_colors = np.zeros((size, size, 3), dtype=np.int64)
+        self.agent_colors[:] = Color.AGENT
+        self.agent_colors[distances > r - 2] = Color.WHITE
+        self.agent_alpha = np.where(distances <= r, 255, 0)
+
+        eye, eye_alpha = load_sprite('eye', self.eye_size)
+        for dx, dy in self.eye_offsets:
+            ex, ey = r + dx, r + dy
+            region = (slice(ey, ey + self.eye_size[1]), slice(ex, ex + self.eye_size[0]))
+            self.blend(self.agent_colors[region], eye, eye_alpha)
+            self.agent_alpha[region] = np.maximum(self.agent_alpha[region], eye_alpha)
+
+
+    def blend(self, target, colors, alpha):
+        """ Draws colors over target in place, weighted by alpha in [0, 255]
+        and rounded like pygame's alpha blits """
+        alpha = alpha[..., None]
+        dst = target.astype(np.int64)
+        target[...] = (((colors - dst) * alpha + colors) >> 8) + dst
+
+
+    def digits(self, number):
+        """ Returns a mask of number drawn in seven segment digits """
+        s = self.stroke
+        text = str(number)
+        mask = np.zeros((9 * s, len(text) * 6 * s - s), dtype=bool)
+        for i, digit in enumerate(text):
+            for segment in DIGIT_SEGMENTS[int(digit)]:
+                x, y, w, h = SEGMENTS[int(segment)]
+                x += i * 6
+                mask[y * s:(y + h) * s, x * s:(x + w) * s] = True
+        return mask
+
+
+    def render(self, cells, door_open, times = None):
+        """ Renders a batch of n frames as an (n, height, width, 3) array.
+        cells holds the agent's cell in each frame (-1 for the slide before it
+        chooses a path, where it waits left of the grid, or None for no agent),
+        door_open is an (n, num_doors) array of door states, and times are
+        the times left shown in the sidebar """
+        door_open = np.asarray(door_open, dtype=bool)
+        n = len(door_open)
+        frames = np.repeat(self.static[None], n, axis=0)
+        for d, (rows, cols, patches) in enumerate(self.doors):
+            frames[:, rows, cols] = patches[door_open[:, d].astype(np.int64)]
+
+        if cells is not None:
+            cells = np.asarray(cells)
+            r = self.agent_r
+            for cell in np.unique(cells):
+                if cell < 0:
+                    cx, cy = self.agent_start_center
+                else:
+                    cx, cy = np.add(self.top_left(self.grid.locations[cell]),
+                                    (self.scale//2, self.scale//2))
+                region = (cells == cell, slice(cy - r, cy + r + 1), slice(cx - r, cx + r + 1))
+                pixels = frames[region]
+                self.blend(pixels, self.agent_colors, self.agent_alpha)
+                frames[region] = pixels
+
+        if times is not None and not self.no_sidebar:
+            times = np.asarray(times)
+            for time in np.unique(times):
+                mask = self.digits(time)
+                h, w = mask.shape
+                x = self.width + self.sidebar_left + (self.sidebar_right - w)//2
+                y = self.text_vspacing * 5 + self.small_fsize
+                region = frames[times == time, y:y + h, x:x + w]
+                region[:, mask] = Color.BLACK
+                frames[times == time, y:y + h, x:x + w] = region
+        return frames
+
+
+    def render_states(self, states, time_limit = None):
+        """ Renders Environment snapshots (SimStates), with the time left
+        counted down from time_limit (the world's by default) """
+        if time_limit is None:
+            time_limit = self.grid.time_limit
+        cells = [self.grid.cell(s.location) for s in states]
+        door_open = [[(s.door_mask >> d) & 1 for d in range(self.grid.num_doors)]
+                     for s in states]
+        times = [time_limit - s.timestep for s in states]
+        return self.render(cells, door_open, times)
@@ -0,0 +1,243 @@
+from main import make_env, make_model
+from utils import read_trials, spawn_rng
+
+import os
+import json
+import time
+import socket
+import argparse
+import multiprocessing
+import numpy as np
+
+
+# Queue layout: job.json describes the simulate_all job, and each shard's task
+# file moves todo/ -> running/ -> a stats file in done/. Claiming a task is a
+# rename, which is atomic on a filesystem shared between hosts. A running
+# task's name ends in its worker's host-pid, and its mtime is the claim time.
+
+
+class ShardStats:
+    """ Mergeable sufficient statistics for a batch of simulations """
+
+    def __init__(self, time_limit, successes = 0, count = 0, finish_times = None):
+        self.successes = successes
+        self.count = count
+        # number of successful episodes that reached the goal on each timestep
+        self.finish_times = np.zeros(time_limit + 1, dtype=np.int64) \
+            if finish_times is None else np.array(finish_times, dtype=np.int64)
+
+
+    def add(self, won, timesteps):
+        self.successes += int(won.sum())
+        self.count += len(won)
+        self.finish_times += np.bincount(timesteps[won],
+                                         minlength=len(self.finish_times))
+
+
+    def merge(self, other):
+        self.successes += other.successes
+        self.count += other.count
+        self.finish_times += other.finish_times
+
+
+    def success_rate(self):
+        return self.successes / self.count if self.count > 0 else 0.
+
+
+    def to_dict(self):
+        return {'successes': self.successes, 'count': self.count,
+                'finish_times': self.finish_times.tolist()}
+
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(len(d['finish_times']) - 1, d['successes'], d['count'],
+                   d['finish_times'])
+
+
+def write_json(path, data):
+    # write then rename so readers never see a partial file
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def read_json(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def submit(queue_dir, job):
+    """ Writes a job description and one task file per shard """
+    for sub in ['todo', 'running', 'done']:
+        os.makedirs(os.path.join(queue_dir, sub), exist_ok=True)
+    write_json(os.path.join(queue_dir, 'job.json'), job)
+
+    num_shards = -(-job['n_simulations'] // job['shard_size'])
+    for shard in range(num_shards):
+        n = min(job['shard_size'], job['n_simulations'] - shard * job['shard_size'])
+        write_json(os.path.join(queue_dir, 'todo', '{:06d}.json'.format(shard)),
+                   {'shard': shard, 'n': n})
+    print('queued {} shards in {}'.format(num_shards, queue_dir))
+
+
+def claim(queue_dir):
+    """ Moves a task from todo/ to running/, returning its new path or None """
+    worker = '{}-{}'.format(socket.gethostname(), os.getpid())
+    for name in sorted(os.listdir(os.path.join(queue_dir, 'todo'))):
+        running = os.path.join(queue_dir, 'running', '{}.{}'.format(name, worker))
+        try:
+            os.rename(os.path.join(queue_dir, 'todo', name), running)
+        except FileNotFoundError:
+            continue  # another worker claimed it first
+        # a rename keeps the time the task was submitted
+        os.utime(running)
+        return running
+    return None
+
+
+def make_job_model(job):
+    trial = [t for t in read_trials() if t['num'] == job['trial']][0]
+    params = argparse.Namespace(prob_stall = job['prob_stall'],
+                                prob_door = job['prob_door'],
+                                time_limit = job['time_limit'])
+    env = make_env(trial, params)
+    original_runtime, _ = env.run(door_changes = trial['door_changes'])
+    return make_model(env, job['model'], trial, original_runtime)
+
+
+def work(queue_dir):
+    """ Runs shards from the queue until it is empty """
+    job = read_json(os.path.join(queue_dir, 'job.json'))
+    sim = make_job_model(job).batch_simulator()
+    num_done = 0
+    while True:
+        running = claim(queue_dir)
+        if running is None:
+            break
+        task = read_json(running)
+        done = os.path.join(queue_dir, 'done', '{:06d}.json'.format(task['shard']))
+        if os.path.exists(done):
+            # requeued while its first worker was still running it
+            os.remove(running)
+            continue
+
+        # Every shard draws from its own child stream of the job's seed, so
+        # the merged result doesn't depend on which worker ran which shard
+        rng = spawn_rng(job['seed'], task['shard'])
+        stats = ShardStats(sim.time_limit)
+        stats.add(*sim.run(task['n'], rng))
+
+        write_json(done, stats.to_dict())
+        try:
+            os.remove(running)
+        except FileNotFoundError:
+            pass  # requeued meanwhile, and skipped once claimed again
+        num_done += 1
+    return num_done
+
+
+def worker_exited(worker):
+    """ Checks if a host-pid worker ran on this host and has exited. Workers
+    on other hosts can't be checked, so they never count as exited """
+    host, pid = worker.rsplit('-', 1)
+    if host != socket.gethostname():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass  # alive, but owned by another user
+    return False
+
+
+def requeue(queue_dir, timeout = None):
+    """ Returns tasks in running/ to todo/ if their worker has exited or, with
+    timeout, if they were claimed more than timeout seconds ago. Returns how
+    many were requeued """
+    num_requeued = 0
+    for name in os.listdir(os.path.join(queue_dir, 'running')):
+        task_name, worker = name.split('.json.')
+        running = os.path.join(queue_dir, 'running', name)
+        try:
+            age = time.time() - os.path.getmtime(running)
+            if not worker_exited(worker) and (timeout is None or age < timeout):
+                continue
+            os.rename(running, os.path.join(queue_dir, 'todo', task_name + '.json'))
+            num_requeued += 1
+        except FileNotFoundError:
+            continue  # finished in the meantime
+    return num_requeued
+
+
+def merge(queue_dir):
+    """ Combines all finished shards into the job's statistics """
+    pending = os.listdir(os.path.join(queue_dir, 'todo')) +\
+              os.listdir(os.path.join(queue_dir, 'running'))
+    if len(pending) > 0:
+        print('warning: {} shards are not finished yet'.format(len(pending)))
+
+    total = None
+    for name in sorted(os.listdir(os.path.join(queue_dir, 'done'))):
+        if not name.endswith('.json'):
+            continue
+        stats = ShardStats.from_dict(read_json(os.path.join(queue_dir, 'done', name)))
+        if total is None:
+            total = stats
+        else:
+            total.merge(stats)
+    return total
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser("sharded simulations argument parser")
+
+    parser.add_argument('command', choices=['submit', 'work', 'requeue', 'merge'])
+    parser.add_argument('--queue-dir', type=str, required=True, help='queue directory shared between workers')
+    parser.add_argument('--workers', type=int, default=1, help='number of local worker processes for work')
+    parser.add_argument('--timeout', type=float, default=None, help='with requeue, also requeue shards claimed more than this many seconds ago, such as those of workers on other hosts')
+
+    parser.add_argument('--trial', type=int, default=1, help='trial to simulate')
+    parser.add_argument('--model', choices=['cf', 'hyp'], default='cf', help='counterfactual or hypothetical model')
+    parser.add_argument('--n-simulations', type=int, default=1000000, help='total number of simulations')
+    parser.add_argument('--shard-size', type=int, default=100000, help='number of simulations per shard')
+    parser.add_argument('--seed', type=int, default=0, help='seed that all shard streams are spawned from')
+    parser.add_argument('--prob-stall', type=float, default=0.12, help='probabilty of agent stalling on any time step')
+    parser.add_argument('--prob-door', type=float, default=0.19, help='probability of door switching on any time step')
+    parser.add_argument('--time-limit', type=int, default=10, help='time limit for agent')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arglist = parse_arguments()
+
+    if arglist.command == 'submit':
+        submit(arglist.queue_dir, {
+            'trial': arglist.trial, 'model': arglist.model,
+            'n_simulations': arglist.n_simulations,
+            'shard_size': arglist.shard_size, 'seed': arglist.seed,
+            'prob_stall': arglist.prob_stall, 'prob_door': arglist.prob_door,
+            'time_limit': arglist.time_limit})
+
+    elif arglist.command == 'work':
+        if arglist.workers > 1:
+            with multiprocessing.Pool(arglist.workers) as pool:
+                num_done = sum(pool.map(work, [arglist.queue_dir] * arglist.workers))
+        else:
+            num_done = work(arglist.queue_dir)
+        print('ran {} shards'.format(num_done))
+
+    elif arglist.command == 'requeue':
+        print('requeued {} shards'.format(requeue(arglist.queue_dir, arglist.timeout)))
+
+    elif arglist.command == 'merge':
+        stats = merge(arglist.queue_dir)
+        if stats is None:
+            print('no finished shards in {}'.format(arglist.queue_dir))
+            import sys; sys.exit(0)
+        print('success rate was {:.4f} across {} simulations'.format(
+              stats.success_rate(), stats.count))
+        print('finish time histogram: {}'.format(stats.finish_times.tolist()))
@@ -0,0 +1,133 @@
+from main import make_env, make_model
+from models import exact_success_probability
+from utils import read_trials, spawn_rng
+
+import csv
+import argparse
+import itertools
+import multiprocessing
+import numpy as np
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser("parameter sweep argument parser")
+
+    parser.add_argument('--prob-stall', nargs='+', default=['0.12'], help='stall probabilities, each a value or start:stop:num')
+    parser.add_argument('--prob-door', nargs='+', default=['0.19'], help='door switching probabilities, each a value or start:stop:num')
+    parser.add_argument('--time-limit', nargs='+', default=['10'], help='time limits, each a value or start:stop:num')
+    parser.add_argument('--trial', type=int, default=0, help='which trial to sweep specifically')
+    parser.add_argument('--models', nargs='+', choices=['cf', 'hyp', 'actual'], default=['cf', 'hyp'], help='models to evaluate')
+    parser.add_argument('--method', choices=['exact', 'batch', 'reweight'], default='exact', help='compute success rates exactly, by batch simulation per point, or by reweighting one batch for all points')
+    parser.add_argument('--n-simulations', type=int, default=10000, help='number of simulations per point with --method batch, or per time limit with --method reweight')
+    parser.add_argument('--base-prob-stall', type=float, default=0.12, help='stall probability simulated at with --method reweight')
+    parser.add_argument('--base-prob-door', type=float, default=0.19, help='door switching probability simulated at with --method reweight')
+    parser.add_argument('--seed', type=int, default=0, help='seed for --method batch and reweight')
+    parser.add_argument('--jobs', type=int, default=0, help='number of processes to spread trials across')
+    parser.add_argument('--output', type=str, default='../../experiment/sweep.csv', help='where to write the results table')
+
+    arglist = parser.parse_args()
+    if arglist.method == 'reweight' and not (0 < arglist.base_prob_stall < 1 and
+                                             0 < arglist.base_prob_door < 1):
+        parser.error('--base-prob-stall and --base-prob-door must be strictly between 0 and 1')
+    if arglist.trial != 0 and arglist.trial not in [t['num'] for t in read_trials()]:
+        parser.error('there is no trial {}'.format(arglist.trial))
+    return arglist
+
+
+def parse_values(values, cast):
+    """ Expands start:stop:num entries into evenly spaced values """
+    parsed = []
+    for v in values:
+        if ':' in v:
+            start, stop, num = v.split(':')
+            values = np.linspace(float(start), float(stop), int(num))
+            parsed += [cast(round(x, 10)) for x in values]
+        else:
+            parsed.append(cast(v))
+    return parsed
+
+
+def sweep_trial(unit):
+    """ Evaluates every parameter point of one trial on a single compiled world """
+    trial, points, arglist = unit
+
+    # The baseline run is deterministic, so running it once at the longest
+    # time limit gives the original runtime for every shorter one too
+    params = argparse.Namespace(prob_stall = points[0][0], prob_door = points[0][1],
+                                time_limit = max(p[2] for p in points))
+    env = make_env(trial, params)
+    original_runtime, _ = env.run(door_changes = trial['door_changes'])
+
+    rows = []
+    for m, model_type in enumerate(arglist.models):
+        model = make_model(env, model_type, trial, original_runtime)
+        if arglist.method == 'reweight':
+            rows += reweight_model(model, model_type, trial, m, points, arglist)
+            continue
+        for p, (prob_stall, prob_door, time_limit) in enumerate(points):
+            sim = model.batch_simulator(prob_stall = prob_stall,
+                                        prob_door = prob_door,
+                                        time_limit = time_limit)
+            if arglist.method == 'exact':
+                rate = exact_success_probability(sim)
+                n = ''
+            else:
+                won, _ = sim.run(arglist.n_simulations, make_rng(arglist, trial, m, p))
+                rate = won.mean()
+                n = arglist.n_simulations
+            rows.append(make_row(trial, model_type, prob_stall, prob_door,
+                                 time_limit, rate, arglist, n))
+    return rows
+
+
+def reweight_model(model, model_type, trial, m, points, arglist):
+    """ Estimates all points sharing a time limit from one batch of simulations """
+    rows = []
+    for time_limit in sorted(set(p[2] for p in points)):
+        same_limit = [p[:2] for p in points if p[2] == time_limit]
+        results = model.reweighted_success_rates(arglist.n_simulations, same_limit,
+            make_rng(arglist, trial, m, time_limit),
+            prob_stall = arglist.base_prob_stall,
+            prob_door = arglist.base_prob_door, time_limit = time_limit)
+        for r in results:
+            rows.append(make_row(trial, model_type, r['prob_stall'], r['prob_door'],
+                                 time_limit, r['success_rate'], arglist,
+                                 arglist.n_simulations, round(r['ess'], 1)))
+    return rows
+
+
+def make_rng(arglist, trial, m, p):
+    # every unit of work gets its own stream, so results don't depend on --jobs
+    return spawn_rng(arglist.seed, trial['num'], m, p)
+
+
+def make_row(trial, model_type, prob_stall, prob_door, time_limit, rate, arglist,
+             n = '', ess = ''):
+    return {'trial': trial['num'], 'model': model_type,
+            'prob_stall': prob_stall, 'prob_door': prob_door,
+            'time_limit': time_limit, 'success_rate': round(rate * 100, 4),
+            'method': arglist.method, 'n_simulations': n,
+            'effective_sample_size': ess}
+
+
+if __name__ == '__main__':
+    arglist = parse_arguments()
+    points = list(itertools.product(parse_values(arglist.prob_stall, float),
+                                    parse_values(arglist.prob_door, float),
+                                    parse_values(arglist.time_limit, int)))
+    trials = [t for t in read_trials() if arglist.trial in [0, t['num']]]
+    units = [(trial, points, arglist) for trial in trials]
+    print('sweeping {} points for {} trials...'.format(len(points), len(trials)))
+
+    if arglist.jobs > 0:
+        with multiprocessing.Pool(arglist.jobs) as pool:
+            results = pool.map(sweep_trial, units)
+    else:
+        results = [sweep_trial(unit) for unit in units]
+
+    with open(arglist.output, 'w') as outfile:
+        w = csv.DictWriter(outfile, results[0][0].keys())
+        w.writeheader()
+        for rows in results:
+            w.writerows(rows)
+    print('saved {} rows to {}'.format(sum(len(rows) for rows in results), arglist.output))
@@ -1,11 +1,8 @@
 import os
-os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = 'hide'
 import json
 import numpy as np
 from numpy.random import rand
-from scipy.stats import binom
 import shutil
-import pygame
 
 
 class Color:
@@ -35,22 +32,90 @@ def get_action_from_location(location_one, location_two):
     return tuple(map(lambda i, j: i - j, location_two, location_one))
 
 
+def spawn_rng(seed, *spawn_key):
+    """ Returns the random stream for one unit of work (e.g. a trial and
+    model), which is the same whichever process runs it and in what order """
+    seed_seq = np.random.SeedSequence(seed, spawn_key = spawn_key)
+    return np.random.Generator(np.random.PCG64(seed_seq))
+
+
 def bernoulli(p):
     if rand() < p:
         return True
     return False
 
 
+class VideoWriter:
+    """ Streams frames into a gif (or mp4, which needs imageio-ffmpeg) as
+    they are rendered. A gif frame is written out once the next different
+    one arrives, so at most one frame is held in memory """
+
+    def __init__(self, file_path, fps = 1.5):
+        self.fps = fps
+        self.writer = None
+        self.file = None
+        self.pending = None
+        self.pending_repeat = 0
+        if file_path.endswith('.gif'):
+            self.file = open(file_path, 'wb')
+        else:
+            import imageio
+            self.writer = imageio.get_writer(file_path, mode = 'I', fps = fps)
+
+
+    def append(self, frame, repeat = 1):
+        if self.writer is not None:
+            for i in range(repeat):
+                self.writer.append_data(frame)
+        elif repeat > 0:
+            # repeats of a frame become one gif frame shown for longer
+            if self.pending is not None and np.array_equal(frame, self.pending):
+                self.pending_repeat += repeat
+                return
+            self.flush()
+            self.pending = np.array(frame)
+            self.pending_repeat = repeat
+
+
+    def flush(self):
+        if self.pending is not None:
+            self.write_gif_frame(self.pending, self.pending_repeat)
+            self.pending = None
+
+
+    def write_gif_frame(self, frame, repeat):
+        """ Writes a frame into the gif, shown for repeat frames' time """
+        from PIL import Image, GifImagePlugin
+        # each frame gets its own palette, as with pillow's own gif writer
+        image = Image.fromarray(frame).convert('P', palette = Image.Palette.ADAPTIVE)
+        if self.file.tell() == 0:
+            header, _ = GifImagePlugin.getheader(image, info = {'loop': 0})
+            self.file.write(b''.join(header))
+        for data in GifImagePlugin.getdata(image, duration = repeat * 1000 / self.fps,
+                                           include_color_table = True):
+            self.file.write(data)
+
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        else:
+            self.flush()
+            self.file.write(b';')  # gif trailer
+            self.file.close()
+
+
 def make_gif(image_dir, file_path, include_00):
+    """ Makes a gif of the pngs saved in image_dir, like a visualized trial """
     import imageio
-    images = []
-    for f in sorted(os.listdir(image_dir)):
-        if not include_00 and f == '00.png': continue
-        images.append(imageio.imread(os.path.join(image_dir, f)))
-    # hold first and last frame a little longer
-    images = [images[0]]*3 + images
-    images += [images[-1]]*3
-    imageio.mimsave(file_path + '.gif', images, fps=1.5)
+    files = [f for f in sorted(os.listdir(image_dir))
+             if f.endswith('.png') and (include_00 or f != '00.png')]
+    video = VideoWriter(file_path + '.gif')
+    for i, f in enumerate(files):
+        # hold first and last frame a little longer
+        repeat = 1 + 3 * (i == 0) + 3 * (i == len(files) - 1)
+        video.append(imageio.v2.imread(os.path.join(image_dir, f))[:, :, :3], repeat)
+    video.close()
 
 
 # read in trial information from json
@@ -60,14 +125,7 @@ def read_trials():
 
 # clear directory or create if doesn't exist
 def make_dir(path):
-    try:
-        os.mkdir(path)
-    except FileExistsError:
-        for f in os.listdir(path):
-            full_f = os.path.join(path, f)
-            if os.path.isfile(full_f):
-                os.remove(full_f)
-            elif os.path.isdir(full_f):
-                shutil.rmtree(full_f)
+    shutil.rmtree(path, ignore_errors = True)
+    os.makedirs(path)
 
 